@@ -0,0 +1,84 @@
+##########################################################
+# Columnar cache of the monthly climate grid exports
+# (gridded_precipitation.js / gridded_temperature.js).
+#
+# The 48 GeoJSON files of a year are consolidated into one
+# GeoParquet table keyed by grid id, with the geometry
+# stored once. Each export is also kept as its own Parquet
+# part, so when an export changes only that file is read
+# again before the table is reassembled.
+##########################################################
+
+import json
+import os
+
+import geopandas as gpd
+import pandas as pd
+
+DATA_DIR = './Data/TimeImpacts'
+CACHE_DIR = './Data/TimeImpacts/Cache'
+N_MONTHS = 24
+
+variables = ['prcp', 'tmax']
+
+# Suffix of the days columns of each variable, as named by the original
+# merges of the precipitation and temperature tables (days_1_x, ...).
+days_suffixes = {'prcp':'_x', 'tmax':'_y'}
+
+
+def export_path(variable, year, month, data_dir=DATA_DIR):
+    return os.path.join(data_dir, f'{variable}_grid_{year}_month_{month}.geojson')
+
+def signature(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+def table_path(year, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, f'climate_grid_{year}.parquet')
+
+def build_year(year, data_dir=DATA_DIR, cache_dir=CACHE_DIR, n_months=N_MONTHS):
+    # Brings the consolidated table for a year up to date, reading only
+    # the exports that changed since the last build. Returns its path.
+    part_dir = os.path.join(cache_dir, f'climate_grid_{year}')
+    os.makedirs(part_dir, exist_ok=True)
+    manifest_path = os.path.join(part_dir, 'manifest.json')
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+
+    geometry_path = os.path.join(part_dir, 'geometry.parquet')
+    parts = []
+    changed = not os.path.exists(table_path(year, cache_dir))
+    for variable in variables:
+        for month in range(1, n_months + 1):
+            source = export_path(variable, year, month, data_dir)
+            part = os.path.join(part_dir, f'{variable}_month_{month}.parquet')
+            parts.append(part)
+            if manifest.get(source) == signature(source) and os.path.exists(part):
+                continue
+
+            df = gpd.read_file(source)
+            if not os.path.exists(geometry_path) or (variable, month) == (variables[0], 1):
+                df[['id', 'geometry']].to_parquet(geometry_path)
+            df = df.drop(columns='geometry').set_index('id')
+            df = df.rename(columns={'days':f'days_{month}{days_suffixes[variable]}'})
+            df.to_parquet(part)
+            manifest[source] = signature(source)
+            changed = True
+
+    if changed:
+        # One inner join of every part on id, instead of successive merges.
+        geometry = gpd.read_parquet(geometry_path).set_index('id')
+        table = pd.concat([geometry] + [pd.read_parquet(part) for part in parts],
+                          axis=1, join='inner')
+        table = gpd.GeoDataFrame(table.reset_index(), geometry='geometry', crs=geometry.crs)
+        table.to_parquet(table_path(year, cache_dir) + '.tmp')
+        os.replace(table_path(year, cache_dir) + '.tmp', table_path(year, cache_dir))
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+    return table_path(year, cache_dir)
+
+def load_year(year, data_dir=DATA_DIR, cache_dir=CACHE_DIR, n_months=N_MONTHS):
+    # All monthly precipitation and temperature columns of a year, by grid id.
+    return gpd.read_parquet(build_year(year, data_dir, cache_dir, n_months))
@@ -0,0 +1,79 @@
+##########################################################
+# Correlation between a metric and climate anomalies
+# summed over every window of months before defoliation,
+# as plotted in F5_LagCorrelations.ipynb.
+#
+# Every window sum comes from one cumulative sum over the
+# monthly columns, and all Pearson correlations and
+# p-values are computed together.
+##########################################################
+
+import numpy as np
+from scipy import stats
+from statsmodels.stats.multitest import fdrcorrection
+
+import window_features
+
+
+def window_sums(values, max_length):
+    # Sums of values (n, months) over every window, shaped
+    # (n, max_length, months) with [:, length, col] covering the
+    # length + 1 months ending at month (months - col - 1). Windows
+    # that would start before the first month are NaN, as are windows
+    # containing a missing month.
+    n_months = values.shape[1]
+    totals, n_missing = window_features.prefix_sums(values)
+
+    length = np.arange(max_length)[:, None]
+    end = n_months - np.arange(n_months)[None, :]
+    start = end - length - 1
+    inside = start >= 0
+    start = np.where(inside, start, 0)
+    sums = totals[:, end] - totals[:, start]
+    invalid = ~inside | (n_missing[:, end] - n_missing[:, start] > 0)
+    sums[invalid] = np.nan
+    return sums
+
+def pearson(x, y):
+    # Pearson r and two-sided p-values between every column of x (n, k)
+    # and y (n), each using the rows where both are present (as
+    # scipy.stats.pearsonr after dropna).
+    valid = ~np.isnan(x) & ~np.isnan(y)[:, None]
+    n = valid.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_mean = np.where(valid, x, 0).sum(axis=0) / n
+        y_mean = np.where(valid, y[:, None], 0).sum(axis=0) / n
+        dx = np.where(valid, x - x_mean, 0)
+        dy = np.where(valid, y[:, None] - y_mean, 0)
+        r = np.einsum('ij,ij->j', dx, dy) / np.sqrt(np.einsum('ij,ij->j', dx, dx)
+                                                    * np.einsum('ij,ij->j', dy, dy))
+    r = np.clip(r, -1, 1)
+
+    # Under the null hypothesis r follows a beta distribution on [-1, 1].
+    p = np.full(r.shape, np.nan)
+    defined = (n > 2) & ~np.isnan(r)
+    shape = n[defined] / 2 - 1
+    p[defined] = 2 * stats.beta.sf(np.abs(r[defined]), shape, shape, loc=-1, scale=2)
+    return r, p
+
+def lag_correlations(df, metric, cols, max_length=8, alpha=0.05, sig_choice='fdr'):
+    # Correlation grid (max_length, months) of metric against the anomaly
+    # columns summed over every window, laid out as in F5 (row = window
+    # length - 1, column = months before the window ends, reversed),
+    # with raw p-values and significance ('fdr' or 'raw'). Windows that
+    # do not fit keep r = 0 and p = 0, as in the original grids.
+    values = df[cols].to_numpy(dtype=np.float64)
+    sums = window_sums(values, max_length)
+    fits = np.arange(len(cols))[None, :] < (len(cols) - np.arange(max_length))[:, None]
+
+    r, p = pearson(sums[:, fits], df[metric].to_numpy(dtype=np.float64))
+    grid = np.zeros(fits.shape)
+    sig = np.zeros(fits.shape)
+    grid[fits], sig[fits] = r, p
+
+    if sig_choice == 'fdr':
+        is_sig, _ = fdrcorrection(sig.reshape(-1), alpha=alpha, method='indep', is_sorted=False)
+        is_sig = is_sig.reshape(fits.shape)
+    else:
+        is_sig = sig <= alpha
+    return grid, sig, is_sig
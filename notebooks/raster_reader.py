@@ -0,0 +1,62 @@
+##########################################################
+# Windowed reads of tiled COGs for the figure notebooks.
+# Only the blocks covering the requested extent are read,
+# and reads at a coarser output pixel size are served from
+# the overviews of the file, so statewide 10 m maps can be
+# plotted without reading the full raster into memory.
+##########################################################
+
+import math
+
+from affine import Affine
+import numpy as np
+from rasterio.features import geometry_mask
+from rasterio.windows import Window, from_bounds
+
+
+def extent_window(raster_file, bounds=None):
+    # Window of the raster covering bounds (in the raster's CRS), snapped
+    # outwards to whole pixels and clipped to the raster.
+    full = Window(0, 0, raster_file.width, raster_file.height)
+    if bounds is None:
+        return full
+    window = from_bounds(*bounds, transform=raster_file.transform)
+    col_off, row_off = math.floor(window.col_off), math.floor(window.row_off)
+    window = Window(col_off, row_off,
+                    math.ceil(window.col_off + window.width) - col_off,
+                    math.ceil(window.row_off + window.height) - row_off)
+    return window.intersection(full)
+
+def overview_factor(raster_file, resolution=None):
+    # Largest overview decimation no coarser than the output pixel size.
+    if resolution is None:
+        return 1
+    target = resolution / max(abs(raster_file.res[0]), abs(raster_file.res[1]))
+    factors = [1] + [f for f in raster_file.overviews(1) if f <= target]
+    return max(factors)
+
+def read_extent(raster_file, bounds=None, resolution=None, indexes=None, mask_polygon=None):
+    # Reads the bands of an open raster covering bounds, at roughly the
+    # given output pixel size (in the units of the raster's CRS). Returns
+    # the image (band, y, x) and its transform, like rasterio.mask.mask.
+    # With mask_polygon, only its bounding box is read and pixels outside
+    # the polygon are set to NaN.
+    if mask_polygon is not None:
+        bounds = mask_polygon.bounds
+    window = extent_window(raster_file, bounds)
+
+    # Reading into a smaller out_shape makes GDAL use the matching overview.
+    factor = overview_factor(raster_file, resolution)
+    height = max(1, math.ceil(window.height / factor))
+    width = max(1, math.ceil(window.width / factor))
+    if indexes is None:
+        indexes = list(range(1, raster_file.count + 1))
+    image = raster_file.read(indexes, window=window, out_shape=(len(indexes), height, width))
+    transform = raster_file.window_transform(window) * Affine.scale(window.width / width,
+                                                                    window.height / height)
+
+    if mask_polygon is not None:
+        outside = geometry_mask([mask_polygon], out_shape=(height, width), transform=transform)
+        image = image.astype(np.float32)
+        image[:, outside] = np.nan
+    return image, transform
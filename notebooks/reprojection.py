@@ -0,0 +1,108 @@
+##########################################################
+# Cached nearest-neighbour reprojection for the figure
+# notebooks (prepare_for_viz). The destination grid and
+# the source pixel feeding each destination pixel (warp
+# LUT) are computed once per (source grid, destination
+# CRS, resolution) and kept in memory and on disk, so
+# reprojecting another raster on the same grid (e.g. the
+# five yearly maps) is a single index gather.
+##########################################################
+
+import hashlib
+import os
+
+from affine import Affine
+import numpy as np
+from rasterio import warp
+from rasterio.crs import CRS
+
+CACHE_DIR = './Data/ReprojectionCache'
+
+# Grids computed in this kernel, by key.
+grids = {}
+
+
+def grid_key(src_transform, src_crs, shape, dst_crs, resolution=None):
+    src_crs, dst_crs = CRS.from_user_input(src_crs), CRS.from_user_input(dst_crs)
+    text = repr((tuple(src_transform)[:6], src_crs.to_wkt(), tuple(shape),
+                 dst_crs.to_wkt(), resolution))
+    return hashlib.sha1(text.encode()).hexdigest()
+
+def compute_grid(src_transform, src_crs, shape, dst_crs, resolution=None, block_rows=512):
+    # Destination grid as chosen by rasterio.warp.reproject, and the flat
+    # index of the nearest source pixel for every destination pixel
+    # (-1 where the destination pixel falls outside the source).
+    height, width = shape
+    west, north = src_transform * (0, 0)
+    east, south = src_transform * (width, height)
+    dst_transform, dst_width, dst_height = warp.calculate_default_transform(
+        src_crs, dst_crs, width, height, min(west, east), min(south, north),
+        max(west, east), max(south, north), resolution=resolution)
+
+    index_dtype = np.int32 if height * width < 2**31 else np.int64
+    lut = np.full(dst_height * dst_width, -1, dtype=index_dtype)
+    inverse = ~src_transform
+    cols = np.arange(dst_width) + 0.5
+    for row in range(0, dst_height, block_rows):
+        rows = np.arange(row, min(row + block_rows, dst_height)) + 0.5
+        # Destination pixel centres, transformed into the source CRS
+        c, r = np.meshgrid(cols, rows)
+        xs, ys = dst_transform * (c.ravel(), r.ravel())
+        xs, ys = warp.transform(dst_crs, src_crs, xs, ys)
+        src_cols, src_rows = inverse * (np.asarray(xs), np.asarray(ys))
+        src_cols, src_rows = np.floor(src_cols), np.floor(src_rows)
+        inside = (src_rows >= 0) & (src_rows < height) & (src_cols >= 0) & (src_cols < width)
+        index = np.where(inside, src_rows * width + src_cols, -1)
+        lut[row * dst_width:row * dst_width + index.size] = index
+    return dst_transform, (dst_height, dst_width), lut
+
+def get_grid(src_transform, src_crs, shape, dst_crs, resolution=None, cache_dir=CACHE_DIR):
+    # Grid from this kernel, from disk, or computed and saved.
+    key = grid_key(src_transform, src_crs, shape, dst_crs, resolution)
+    if key in grids:
+        return grids[key]
+
+    path = None if cache_dir is None else os.path.join(cache_dir, f'{key}.npz')
+    if path is not None and os.path.exists(path):
+        cached = np.load(path)
+        grid = Affine(*cached['transform']), tuple(cached['shape']), cached['lut']
+    else:
+        grid = compute_grid(src_transform, src_crs, shape, dst_crs, resolution)
+        if path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.savez(path + '.tmp.npz', transform=np.array(grid[0])[:6],
+                     shape=np.array(grid[1]), lut=grid[2])
+            os.replace(path + '.tmp.npz', path)
+    grids[key] = grid
+    return grid
+
+def reproject_cached(image, src_transform, src_crs, dst_crs, resolution=None, cache_dir=CACHE_DIR):
+    # Drop-in for rasterio.warp.reproject(source=image, ..., resampling=
+    # Resampling.nearest, dst_nodata=np.nan) on a (band, y, x) image.
+    # Returns the reprojected image and its transform.
+    dst_transform, dst_shape, lut = get_grid(src_transform, src_crs, image.shape[-2:],
+                                             dst_crs, resolution, cache_dir)
+    n_bands = image.shape[0]
+    new_image = np.full((n_bands, lut.size), np.nan, dtype=np.result_type(image.dtype, np.float32))
+    inside = lut >= 0
+    new_image[:, inside] = image.reshape(n_bands, -1)[:, lut[inside]]
+    return new_image.reshape((n_bands,) + dst_shape), dst_transform
+
+def reproject_raster(raster_file, dst_crs, resolution=None, cache_dir=CACHE_DIR):
+    # Reads and reprojects a whole raster, caching the result on disk
+    # keyed by the file and its modification time.
+    stat = os.stat(raster_file.name)
+    key = grid_key(raster_file.transform, raster_file.crs,
+                   (raster_file.height, raster_file.width), dst_crs, resolution)
+    name = hashlib.sha1(f'{os.path.abspath(raster_file.name)}:{stat.st_mtime_ns}:{key}'.encode()).hexdigest()
+    path = None if cache_dir is None else os.path.join(cache_dir, f'{name}.npz')
+    if path is not None and os.path.exists(path):
+        cached = np.load(path)
+        return cached['image'], Affine(*cached['transform'])
+
+    new_image, new_transform = reproject_cached(raster_file.read(), raster_file.transform,
+                                                raster_file.crs, dst_crs, resolution, cache_dir)
+    if path is not None:
+        np.savez(path + '.tmp.npz', image=new_image, transform=np.array(new_transform)[:6])
+        os.replace(path + '.tmp.npz', path)
+    return new_image, new_transform
@@ -0,0 +1,46 @@
+##########################################################
+# Window aggregates of monthly climate columns (sums over
+# every run of consecutive months) as a feature matrix for
+# the regressions in T5_LagRegression.ipynb, computed from
+# a single cumulative sum over the columns.
+# lag_correlation.py shares the same prefix sums.
+##########################################################
+
+import numpy as np
+
+
+def prefix_sums(values):
+    # Cumulative sums of values (n, months) with a leading zero column,
+    # and the cumulative number of missing values, so that the sum over
+    # months i..j is totals[:, j+1] - totals[:, i] and is missing when
+    # the missing counts differ.
+    n_rows, n_months = values.shape
+    missing = np.isnan(values)
+    totals = np.zeros((n_rows, n_months + 1))
+    np.cumsum(np.where(missing, 0, values), axis=1, out=totals[:, 1:])
+    n_missing = np.zeros((n_rows, n_months + 1), dtype=np.int64)
+    np.cumsum(missing, axis=1, out=n_missing[:, 1:])
+    return totals, n_missing
+
+def window_bounds(n_months, min_length, max_length):
+    # First and last month of every window, ordered by window length, then
+    # first month.
+    starts, ends = [], []
+    for length in range(min_length, max_length + 1):
+        for i in range(0, n_months - length):
+            starts.append(i)
+            ends.append(i + length)
+    return np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+
+def window_features(df, cols, prefix, min_length, max_length, dtype=np.float64):
+    # Sums of cols over every window (columns i..i+length for length in
+    # min_length..max_length), as one (rows, windows) matrix and the
+    # matching column names f'{prefix}_{i+1}_{i+length+1}'.
+    totals, n_missing = prefix_sums(df[cols].to_numpy(dtype=np.float64))
+    starts, ends = window_bounds(len(cols), min_length, max_length)
+
+    features = np.empty((len(df), starts.size), dtype=dtype)
+    np.subtract(totals[:, ends + 1], totals[:, starts], out=features, casting='same_kind')
+    features[n_missing[:, ends + 1] != n_missing[:, starts]] = np.nan
+    names = [f'{prefix}_{i + 1}_{j + 1}' for i, j in zip(starts, ends)]
+    return features, names
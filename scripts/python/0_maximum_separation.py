@@ -1,11 +1,11 @@
 import argparse
 import json
-import time
 
 import ee
 
 import geometries
 import preprocessing
+import scheduler
 
 
 ##############################################################
@@ -18,6 +18,8 @@ parser = argparse.ArgumentParser(
 # The script will ONLY submit the run when -s or --submit is included.
 parser.add_argument('--submit', '-s', action='store_true')
 
+scheduler.add_arguments(parser)
+
 # Whether to export results to a cloud storage bucket. If true,
 # `bucket` must also be set.
 parser.add_argument('--cloudstorage', '-C', action='store_true')
@@ -117,7 +119,15 @@ grid = geometry.coveringGrid(proj)
 gridSize = grid.size().getInfo()
 gridList = grid.toList(gridSize)
 
-for i in range(gridSize):
+if not args.submit:
+    # Plan the run and exit instead of exporting.
+    import planner
+    planner.run(args, grid, args.data, preprocessing.resolutions[args.data],
+                list(range(args.start, args.end + 1)), ['preprocessing', 'phenology'],
+                written_per_run=4)
+
+def make_task(i):
+    # The export task of tile i, started by scheduler.run_tasks.
     gridCell = ee.Feature(gridList.get(i)).geometry()
 
     ##################################################################
@@ -231,71 +241,80 @@ for i in range(gridSize):
     # Export results
     ##################################################
 
-    # Save full image to assets
-    if args.submit:
-        if args.cloudstorage:
-            # Save in a Cloud Storage Bucket
-            if gridSize > 1:
-                asset_name = f'{assetID}_tile_{i}'
-                image_name = f'{file_name_prefix}_tile_{i}'
-                description = f'{description_base}_tile_{i}'
-            else:
-                asset_name = assetID
-                image_name = file_name_prefix
-                description = description_base
-
-            task = ee.batch.Export.image.toCloudStorage(
-                image=pheno,
-                description=description,
-                bucket=args.bucket,
-                fileNamePrefix=image_name,
-                region=gridCell,
-                scale=preprocessing.resolutions[args.data],
-                crs=args.crs,
-                maxPixels=1e10,
-                formatOptions={
-                    'cloudOptimized': True,
-                }
-            )
-            task.start()
-
-            # Create an image manifest for adding image as an asset
-            image_manifests[i] = {
-                'name': asset_name,
-                'properties': {
-                    'source':args.data,
-                    'start':args.start,
-                    'end':args.end,
-                    'method':'Maximum Separability'
-                },
-                'tilesets': [
-                    {'id': '0', 'sources': [ {'uris': [f'gs://{args.bucket}/{file_name_prefix}.tif']}]}
-                ],
-                'startTime': f'{args.start}-01-01T00:00:00.000000000Z',
-                'endTime': f'{args.end+1}-01-01T00:00:00.000000000Z'
+    if args.cloudstorage:
+        # Save in a Cloud Storage Bucket
+        if gridSize > 1:
+            image_name = f'{file_name_prefix}_tile_{i}'
+            description = f'{description_base}_tile_{i}'
+        else:
+            image_name = file_name_prefix
+            description = description_base
+
+        task = ee.batch.Export.image.toCloudStorage(
+            image=pheno,
+            description=description,
+            bucket=args.bucket,
+            fileNamePrefix=image_name,
+            region=gridCell,
+            scale=preprocessing.resolutions[args.data],
+            crs=args.crs,
+            maxPixels=1e10,
+            formatOptions={
+                'cloudOptimized': True,
             }
+        )
+    else:
+        # Save as an Earth Engine Asset
+        if gridSize > 1:
+            image_name = f'{assetID}_tile_{i}'
+            description = f'{description_base}_tile_{i}'
         else:
-            # Save as an Earth Engine Asset
-            if gridSize > 1:
-                image_name = f'{assetID}_tile_{i}'
-                description = f'{description_base}_tile_{i}'
-            else:
-                image_name = assetID
-                description = description_base
-
-            task = ee.batch.Export.image.toAsset(
-                image=pheno,
-                description=description,
-                assetId=image_name,
-                region=gridCell, 
-                scale=preprocessing.resolutions[args.data],
-                crs=args.crs,
-                pyramidingPolicy={'.default': 'mean'},
-                maxPixels=1e10
-            )                
-            task.start()
-        # Wait to not spam task submissions to GEE
-        time.sleep(0.1)
+            image_name = assetID
+            description = description_base
+
+        task = ee.batch.Export.image.toAsset(
+            image=pheno,
+            description=description,
+            assetId=image_name,
+            region=gridCell, 
+            scale=preprocessing.resolutions[args.data],
+            crs=args.crs,
+            pyramidingPolicy={'.default': 'mean'},
+            maxPixels=1e10
+        )                
+    return task
+
+
+##################################################################
+# Submit every tile, skipping those finished in a previous run
+##################################################################
+
+scheduler.run_tasks(make_task, list(range(gridSize)),
+                    args.ledger or f'{description_base}_{args.start}_{args.end}_tiles.jsonl',
+                    max_in_flight=args.max_in_flight)
+
 if args.cloudstorage:
+    # Create an image manifest for adding each image as an asset
+    for i in range(gridSize):
+        if gridSize > 1:
+            asset_name = f'{assetID}_tile_{i}'
+            image_name = f'{file_name_prefix}_tile_{i}'
+        else:
+            asset_name = assetID
+            image_name = file_name_prefix
+        image_manifests[i] = {
+            'name': asset_name,
+            'properties': {
+                'source':args.data,
+                'start':args.start,
+                'end':args.end,
+                'method':'Maximum Separability'
+            },
+            'tilesets': [
+                {'id': '0', 'sources': [ {'uris': [f'gs://{args.bucket}/{image_name}.tif']}]}
+            ],
+            'startTime': f'{args.start}-01-01T00:00:00.000000000Z',
+            'endTime': f'{args.end+1}-01-01T00:00:00.000000000Z'
+        }
     with open("image_manifests.json", 'w')  as f:
-        json.dump(image_manifests, f)
\ No newline at end of file
+        json.dump(image_manifests, f)
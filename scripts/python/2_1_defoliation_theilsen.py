@@ -5,6 +5,7 @@ import ee
 
 import geometries
 import preprocessing
+import scheduler
 
 
 ##############################################################
@@ -17,6 +18,8 @@ parser = argparse.ArgumentParser(
 # The script will ONLY submit the run when -s or --submit is included.
 parser.add_argument('--submit', '-s', action='store_true')
 
+scheduler.add_arguments(parser)
+
 # Whether to export results to a cloud storage bucket. If true,
 # `bucket` must also be set.
 parser.add_argument('--cloudstorage', '-C', action='store_true')
@@ -125,7 +128,16 @@ grid = geometry.coveringGrid(proj)
 gridSize = grid.size().getInfo()
 gridList = grid.toList(gridSize)
 
-for i in range(gridSize):
+if not args.submit:
+    # Plan the run and exit instead of exporting.
+    import planner
+    planner.run(args, grid, args.data, preprocessing.resolutions[args.data],
+                list(range(int(args.start), int(args.end) + 1)), ['preprocessing', 'anomaly'],
+                written_per_year=2, series=False)
+
+def make_task(tile):
+    # The export task of one year of tile i, started by scheduler.run_tasks.
+    i, year = tile
     gridCell = ee.Feature(gridList.get(i)).geometry()
 
     ##################################################################
@@ -152,128 +164,140 @@ for i in range(gridSize):
         return ee.Image([slope, offset])
     models = models.map(decompress).mosaic()
 
-    years = list(range(args.start, args.end + 1))
+    start_date = ee.Date.fromYMD(year, 1, 1)
+    end_date = ee.Date.fromYMD(year + 1, 1, 1)
 
-    for year in years:
-        start_date = ee.Date.fromYMD(year, 1, 1)
-        end_date = ee.Date.fromYMD(year + 1, 1, 1)
-
-        if args.data == 'Landsat':
-            col = preprocessing.preprocess_Landsat(start_date, end_date,
-                                                   gridCell, phenology)
-        elif args.data == 'MODIS':
-            col = preprocessing.preprocess_MODIS(start_date, end_date,
-                                                 gridCell, phenology)
-        elif args.data == 'Sentinel2':
-            col = preprocessing.preprocess_Sentinel2(start_date, end_date,
-                                                     gridCell, phenology)
-        elif args.data == 'HLS':
-            col = preprocessing.preprocess_HLS(start_date, end_date,
+    if args.data == 'Landsat':
+        col = preprocessing.preprocess_Landsat(start_date, end_date,
                                                gridCell, phenology)
+    elif args.data == 'MODIS':
+        col = preprocessing.preprocess_MODIS(start_date, end_date,
+                                             gridCell, phenology)
+    elif args.data == 'Sentinel2':
+        col = preprocessing.preprocess_Sentinel2(start_date, end_date,
+                                                 gridCell, phenology)
+    elif args.data == 'HLS':
+        col = preprocessing.preprocess_HLS(start_date, end_date,
+                                           gridCell, phenology)
+
+    if args.rescale:
+        col = preprocessing.rescale_years(col, args.start, args.end)
+
+
+    ######################################
+    # Estimate defoliation in given window
+    ######################################
+
+    # Calculate anomaly
+    def calc_anom(image):
+        slope = models.select('slope')
+        offset = models.select('offset')
+        doy = image.select('doy')
+        predict = slope.multiply(doy).add(offset)
+        anom = image.select('EVI').subtract(predict)
+
+        return image.addBands(anom.rename('EVI_anom'))
+
+    def calc_statistics(images): 
+        images = images.map(calc_anom)
+        mean_intensity = images.select("EVI_anom").filter(ee.Filter.dayOfYear(161, 208)).mean().rename("mean_intensity")
+
+        return mean_intensity
+
+    defol = calc_statistics(col.filterDate(start_date, end_date))
+    defol = (defol.set('source', args.data)
+                  .set('rescaled', args.rescale)
+                  .set('start', args.start)
+                  .set('end', args.end)
+                  .set('min', args.min)
+                  .set('max', args.max)
+                  .set('year', year))
+    defol = (defol.subtract(args.min)
+                .divide(args.max-args.min).multiply(65_535).uint16())
+
+
+    #################################
+    # Submit batch job
+    #################################
+
+    if args.cloudstorage:
+        # Save in a Cloud Storage Bucket
+        if gridSize > 1:
+            image_name = f'{file_name_prefix}_{year}_tile_{i}'
+            description = f'{description_base}_{year}_tile_{i}'
+        else:
+            image_name = f'{file_name_prefix}_{year}'
+            description = f'{description_base}_{year}'
+
+        task = ee.batch.Export.image.toCloudStorage(
+            image=defol,
+            description=description,
+            bucket=args.bucket,
+            fileNamePrefix=image_name,
+            region=gridCell,
+            scale=preprocessing.resolutions[args.data],
+            crs=args.crs,
+            maxPixels=1e10,
+            formatOptions={
+                'cloudOptimized': True,
+            }
+        )
+    else:
+        imageName = f'{assetID}_{year}'
+        description = f'{description_base}_{year}'
+        if gridSize > 1:
+            imageName = f'{assetID}_tile_{i}'
+            description = f'{description}_tile_{i}'
+
+        task = ee.batch.Export.image.toAsset(
+            image=defol,
+            description=description,
+            assetId=imageName,
+            region=gridCell, 
+            scale=preprocessing.resolutions[args.data],
+            crs=args.crs,
+            pyramidingPolicy={'.default': 'mean'},
+            maxPixels=1e10
+        )
+    return task
+
+
+##################################################################
+# Submit every tile and year, skipping those finished in a
+# previous run
+##################################################################
+
+years = list(range(args.start, args.end + 1))
+scheduler.run_tasks(make_task, [(i, year) for i in range(gridSize) for year in years],
+                    args.ledger or f'{description_base}_{args.start}_{args.end}_tiles.jsonl',
+                    max_in_flight=args.max_in_flight)
 
-        if args.rescale:
-            col = preprocessing.rescale_years(col, args.start, args.end)
-
-        
-        ######################################
-        # Estimate defoliation in given window
-        ######################################
-
-        # Calculate anomaly
-        def calc_anom(image):
-            slope = models.select('slope')
-            offset = models.select('offset')
-            doy = image.select('doy')
-            predict = slope.multiply(doy).add(offset)
-            anom = image.select('EVI').subtract(predict)
-
-            return image.addBands(anom.rename('EVI_anom'))
-
-        def calc_statistics(images): 
-            images = images.map(calc_anom)
-            mean_intensity = images.select("EVI_anom").filter(ee.Filter.dayOfYear(161, 208)).mean().rename("mean_intensity")
-
-            return mean_intensity
-        
-        defol = calc_statistics(col.filterDate(start_date, end_date))
-        defol = (defol.set('source', args.data)
-                      .set('rescaled', args.rescale)
-                      .set('start', args.start)
-                      .set('end', args.end)
-                      .set('min', args.min)
-                      .set('max', args.max)
-                      .set('year', year))
-        defol = (defol.subtract(args.min)
-                    .divide(args.max-args.min).multiply(65_535).uint16())
-
-
-        #################################
-        # Submit batch job
-        #################################
-
-        if args.submit:
-            if args.cloudstorage:
-                # Save in a Cloud Storage Bucket
-                if gridSize > 1:
-                    asset_name = f'{assetID}_{year}_tile_{i}'
-                    image_name = f'{file_name_prefix}_{year}_tile_{i}'
-                    description = f'{description_base}_{year}_tile_{i}'
-                else:
-                    asset_name = f'{assetID}_{year}'
-                    image_name = f'{file_name_prefix}_{year}'
-                    description = f'{description_base}_{year}'
-
-                task = ee.batch.Export.image.toCloudStorage(
-                    image=defol,
-                    description=description,
-                    bucket=args.bucket,
-                    fileNamePrefix=image_name,
-                    region=gridCell,
-                    scale=preprocessing.resolutions[args.data],
-                    crs=args.crs,
-                    maxPixels=1e10,
-                    formatOptions={
-                        'cloudOptimized': True,
-                    }
-                )
-                task.start()
-                
-                # Create an image manifest for adding image as an asset
-                image_manifests[f"{year}_{i}"] = {
-                    'name': asset_name,
-                    'properties': {
-                        'source':args.data,
-                        'start':args.start,
-                        'end':args.end,
-                        'max':args.max,
-                        'min':args.min,
-                        'rescaled':str(args.rescale),
-                        'year':year
-                    },
-                    'tilesets': [
-                        {'id': '0', 'sources': [ {'uris': [f'gs://{args.bucket}/{image_name}.tif']}]}
-                    ],
-                    'startTime': f'{args.start}-01-01T00:00:00.000000000Z',
-                    'endTime': f'{args.end+1}-01-01T00:00:00.000000000Z'
-                }
-            else:
-                imageName = f'{assetID}_{year}'
-                description = f'{description_base}_{year}'
-                if gridSize > 1:
-                    imageName = f'{assetID}_tile_{i}'
-                    description = f'{description}_tile_{i}'
-
-                task = ee.batch.Export.image.toAsset(
-                    image=defol,
-                    description=description,
-                    assetId=imageName,
-                    region=gridCell, 
-                    scale=preprocessing.resolutions[args.data],
-                    crs=args.crs,
-                    pyramidingPolicy={'.default': 'mean'},
-                    maxPixels=1e10
-                )
-                task.start()
 if args.cloudstorage:
+    # Create an image manifest for adding each image as an asset
+    for i in range(gridSize):
+        for year in years:
+            if gridSize > 1:
+                asset_name = f'{assetID}_{year}_tile_{i}'
+                image_name = f'{file_name_prefix}_{year}_tile_{i}'
+            else:
+                asset_name = f'{assetID}_{year}'
+                image_name = f'{file_name_prefix}_{year}'
+            image_manifests[f"{year}_{i}"] = {
+                'name': asset_name,
+                'properties': {
+                    'source':args.data,
+                    'start':args.start,
+                    'end':args.end,
+                    'max':args.max,
+                    'min':args.min,
+                    'rescaled':str(args.rescale),
+                    'year':year
+                },
+                'tilesets': [
+                    {'id': '0', 'sources': [ {'uris': [f'gs://{args.bucket}/{image_name}.tif']}]}
+                ],
+                'startTime': f'{args.start}-01-01T00:00:00.000000000Z',
+                'endTime': f'{args.end+1}-01-01T00:00:00.000000000Z'
+            }
     with open("image_manifests.json", 'w')  as f:
         json.dump(image_manifests, f)
\ No newline at end of file
@@ -1,6 +1,7 @@
 import argparse
 
 import geometries
+import scheduler
 
 import ee 
 
@@ -14,6 +15,8 @@ parser = argparse.ArgumentParser(
 # The script will ONLY submit the run when -s or --submit is included.
 parser.add_argument('--submit', '-s', action='store_true')
 
+scheduler.add_arguments(parser)
+
 # The project to submit the code in. You may be prompted to to authenticate.
 parser.add_argument('--project', '-p', action='store', default=None, required=True)
 
@@ -85,8 +88,14 @@ grid = geometry.coveringGrid(proj)
 gridSize = grid.size().getInfo()
 gridList = grid.toList(gridSize)
 
-for i in range(gridSize):
-  
+if not args.submit:
+    # Plan the run and exit instead of exporting.
+    import planner
+    planner.run(args, grid, 'Sentinel2', 10, [args.year], ['preprocessing', 'anomaly'],
+                written_per_year=8, series=False)
+
+def make_task(i):
+    # The export task of tile i, started by scheduler.run_tasks.
     gridCell = ee.Feature(gridList.get(i)).geometry()
 
     #################################
@@ -176,22 +185,30 @@ for i in range(gridSize):
     # Submit batch job
     #################################
 
-    if args.submit:
-        defol = calc_statistics(s2.filterDate(start_date, end_date))
-        
-        if gridSize > 1:
-            imageName = f'{assetID}_tile_{i}'
-        else:
-            imageName = assetID
-
-        task = ee.batch.Export.image.toAsset(
-            image            = defol,
-            description      = description,
-            assetId          = imageName,
-            region           = gridCell, 
-            scale            = 10,
-            crs              = args.crs,
-            pyramidingPolicy = {'.default': 'mean'},
-            maxPixels        = 1e10
-        )
-        task.start()
\ No newline at end of file
+    defol = calc_statistics(s2.filterDate(start_date, end_date))
+    
+    if gridSize > 1:
+        imageName = f'{assetID}_tile_{i}'
+    else:
+        imageName = assetID
+
+    task = ee.batch.Export.image.toAsset(
+        image            = defol,
+        description      = description,
+        assetId          = imageName,
+        region           = gridCell, 
+        scale            = 10,
+        crs              = args.crs,
+        pyramidingPolicy = {'.default': 'mean'},
+        maxPixels        = 1e10
+    )
+    return task
+
+
+##################################################################
+# Submit every tile, skipping those finished in a previous run
+##################################################################
+
+scheduler.run_tasks(make_task, list(range(gridSize)),
+                    args.ledger or f'{description}_{args.year}_{args.period}_tiles.jsonl',
+                    max_in_flight=args.max_in_flight)
@@ -5,6 +5,7 @@ import ee
 import geometries
 import masking
 import preprocessing
+import scheduler
 
 
 ##############################################################
@@ -17,6 +18,8 @@ parser = argparse.ArgumentParser(
 # The script will ONLY submit the run when -s or --submit is included.
 parser.add_argument('--submit', '-s', action='store_true')
 
+scheduler.add_arguments(parser)
+
 # The project to submit the code in. 
 # You may be prompted to to authenticate.
 parser.add_argument('--project', '-p', action='store', 
@@ -109,7 +112,16 @@ grid = geometry.coveringGrid(proj)
 gridSize = grid.size().getInfo()
 gridList = grid.toList(gridSize)
 
-for i in range(gridSize):
+if not args.submit:
+    # Plan the run and exit instead of exporting.
+    import planner
+    planner.run(args, grid, args.data, preprocessing.resolutions[args.data],
+                list(range(int(args.start), int(args.end) + 1)), ['classification', 'denoise'],
+                read_scenes=False, read_bytes_per_year=4, written_per_year=1, series=False)
+
+def make_task(tile):
+    # The export task of one year of tile i, started by scheduler.run_tasks.
+    i, year = tile
 
     ###############################################################################
     # Create buffer around region to ensure accurate denoising at grid cell edges
@@ -118,53 +130,60 @@ for i in range(gridSize):
     gridCell = ee.Feature(gridList.get(i)).geometry()
     gridCellBuffer = gridCell.buffer(distance=400)
 
-    years = list(range(args.start, args.end + 1))
-
-    for year in years:
-        ################################################
-        # Classify pixels within buffered grid cell
-        ################################################
-
-        if args.mask == 'New_York_v1':
-            qa_mask = masking.generate_qa_mask_v1(year, gridCellBuffer)
-        
-        defol_gridCell = (defol_coll.filter(ee.Filter.eq('year', year))
-                                    .filterBounds(gridCellBuffer)
-                                    .mosaic()
-                                    .clip(gridCellBuffer))
-        class_gridCell = (defol_gridCell.lte(args.threshold)
-                                        .updateMask(qa_mask))
-        
-        ################################################
-        # Remove pixels that are part of small patches
-        ################################################
-
-        groups_gridCell = class_gridCell.connectedPixelCount(15, False)
-        too_small = groups_gridCell.lte(10)
-        
-        groups_denoised = class_gridCell.And(too_small.Not()).toUint8()
-        
-        groups_denoised = groups_denoised.set('year', args.year)
-
-        #################################
-        # Submit batch job
-        #################################
-
-        if args.submit:
-            assetID = f'{assetID}_{year}'
-            description = f'{description_base}_{year}'
-            if gridSize > 1:
-                imageName = f'{assetID}_tile_{i}'
-                description = f'{description}_tile_{i}'
-
-            task = ee.batch.Export.image.toAsset(
-                image=groups_denoised,
-                description=description,
-                assetId=imageName,
-                region=gridCell, 
-                scale=preprocessing.resolutions[args.data],
-                crs=args.crs,
-                pyramidingPolicy={'.default': 'mean'},
-                maxPixels=1e10
-            )
-            task.start()
\ No newline at end of file
+    ################################################
+    # Classify pixels within buffered grid cell
+    ################################################
+
+    if args.mask == 'New_York_v1':
+        qa_mask = masking.generate_qa_mask_v1(year, gridCellBuffer)
+    
+    defol_gridCell = (defol_coll.filter(ee.Filter.eq('year', year))
+                                .filterBounds(gridCellBuffer)
+                                .mosaic()
+                                .clip(gridCellBuffer))
+    class_gridCell = (defol_gridCell.lte(args.threshold)
+                                    .updateMask(qa_mask))
+    
+    ################################################
+    # Remove pixels that are part of small patches
+    ################################################
+
+    groups_gridCell = class_gridCell.connectedPixelCount(15, False)
+    too_small = groups_gridCell.lte(10)
+    
+    groups_denoised = class_gridCell.And(too_small.Not()).toUint8()
+    
+    groups_denoised = groups_denoised.set('year', year)
+
+    #################################
+    # Submit batch job
+    #################################
+
+    imageName = f'{assetID}_{year}'
+    description = f'{description_base}_{year}'
+    if gridSize > 1:
+        imageName = f'{imageName}_tile_{i}'
+        description = f'{description}_tile_{i}'
+
+    task = ee.batch.Export.image.toAsset(
+        image=groups_denoised,
+        description=description,
+        assetId=imageName,
+        region=gridCell, 
+        scale=preprocessing.resolutions[args.data],
+        crs=args.crs,
+        pyramidingPolicy={'.default': 'mean'},
+        maxPixels=1e10
+    )
+    return task
+
+
+##################################################################
+# Submit every year of every tile, skipping those finished in a
+# previous run
+##################################################################
+
+years = list(range(int(args.start), int(args.end) + 1))
+scheduler.run_tasks(make_task, [(i, year) for i in range(gridSize) for year in years],
+                    args.ledger or f'{description_base}_{args.start}_{args.end}_tiles.jsonl',
+                    max_in_flight=args.max_in_flight)
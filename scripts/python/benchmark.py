@@ -0,0 +1,246 @@
+##########################################################
+# Benchmarks every stage of the local pipeline on
+# synthetic cubes (see synthetic.py): preprocessing,
+# phenology, Theil-Sen, anomaly, classification and
+# denoise. Reports pixels per second and peak resident
+# memory (ru_maxrss) for each stage, and throughput across
+# worker counts.
+##########################################################
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import math
+import os
+import resource
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+
+import local_defoliation
+import local_denoise
+import local_phenology
+import local_preprocessing
+import local_trends
+import synthetic
+
+stages = ['preprocessing', 'phenology', 'theil_sen', 'anomaly', 'classification', 'denoise']
+
+
+# Arrays each stage reads.
+stage_inputs = {'preprocessing':['stack', 'dates'], 'phenology':['EVI', 'doy'],
+                'theil_sen':['EVI', 'doy', 'SoS', 'EoS'],
+                'anomaly':['EVI', 'dates', 'doy', 'slope', 'offset'],
+                'classification':['scores'], 'denoise':['classes']}
+
+def run_stage(stage, data, start, end, threshold, max_size):
+    # Runs one stage on the arrays in data, adding the arrays it returns.
+    if stage == 'preprocessing':
+        data['EVI'], data['doy'] = local_preprocessing.preprocess_Sentinel2(data.pop('stack'),
+                                                                            data['dates'])
+    elif stage == 'phenology':
+        data.update(local_phenology.phenology(data['EVI'], data['doy']))
+    elif stage == 'theil_sen':
+        doy = data['doy'][:, None, None]
+        in_season = (doy >= data['SoS']) & (doy <= data['EoS'])
+        data['slope'], data['offset'] = local_trends.theil_sen(
+            np.where(in_season, data['EVI'], np.nan), data['doy'])
+    elif stage == 'anomaly':
+        sums, counts = local_defoliation.accumulate_anomalies(
+            data['EVI'], data['dates'], data['doy'], data['slope'], data['offset'], start, end)
+        data['scores'] = local_defoliation.mean_intensity(sums, counts)
+    elif stage == 'classification':
+        data['classes'] = data['scores'] < threshold
+    elif stage == 'denoise':
+        for year_classes in data['classes']:
+            local_denoise.denoise_array(year_classes, max_size=max_size)
+
+def run_stages(tile, shape, start, end, threshold, max_size, directory=None):
+    # Runs every stage on the synthetic cube for one tile. Returns the time
+    # spent in each stage. With a directory, the inputs of every stage are
+    # saved there first, for stage_memory.
+    stack, dates, _, _, _ = synthetic.synthetic_cube(shape, start, end, seed=tile)
+    data = {'stack':stack, 'dates':dates}
+    del stack
+    seconds = {}
+    for stage in stages:
+        if directory is not None:
+            np.savez(os.path.join(directory, f'{stage}.npz'),
+                     **{name:data[name] for name in stage_inputs[stage]})
+        begin = time.perf_counter()
+        run_stage(stage, data, start, end, threshold, max_size)
+        seconds[stage] = time.perf_counter() - begin
+    return {'tile':tile, 'seconds':seconds}
+
+def peak_rss_mb():
+    # Peak resident set size of this process so far (ru_maxrss, in
+    # kilobytes on Linux and bytes on macOS).
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+def stage_memory(stage, directory, start, end, threshold, max_size):
+    # Peak resident memory of this process after loading the inputs of one
+    # stage from directory and running it, and how much they raised it.
+    baseline = peak_rss_mb()
+    with np.load(os.path.join(directory, f'{stage}.npz')) as saved:
+        data = {name:saved[name] for name in stage_inputs[stage]}
+    run_stage(stage, data, start, end, threshold, max_size)
+    peak = peak_rss_mb()
+    return {'peak_rss_mb':peak, 'rss_increase_mb':peak - baseline}
+
+def measure_memory(shape, start, end, threshold, max_size=10):
+    # Peak resident memory of every stage of one tile. ru_maxrss only grows
+    # and worker processes start from the peak of the process they are
+    # forked from, so the inputs are generated in one worker and every
+    # stage then runs alone in a new worker, forked from this (small)
+    # process.
+    with tempfile.TemporaryDirectory() as directory:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            executor.submit(run_stages, 0, shape, start, end, threshold, max_size,
+                            directory).result()
+        memory = {}
+        for stage in stages:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                memory[stage] = executor.submit(stage_memory, stage, directory, start, end,
+                                                threshold, max_size).result()
+    return memory
+
+def brute_force_theil_sen(EVI, doy):
+    # Reference Theil-Sen slopes from every pairwise slope of every pixel
+    # and np.nanmedian.
+    n_time = EVI.shape[0]
+    y = EVI.reshape(n_time, -1).T.astype(np.float64)
+    x = np.asarray(doy, dtype=np.float64)
+    i, j = np.triu_indices(n_time, 1)
+    dx = x[j] - x[i]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slopes = (y[:, j] - y[:, i]) / dx
+    slopes[:, dx == 0] = np.nan
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmedian(slopes, axis=1).reshape(EVI.shape[1:])
+
+def check_theil_sen(shape, start, end):
+    # Times local_trends.theil_sen against brute force on the in-season EVI
+    # of one synthetic tile. Returns the seconds of each and the largest
+    # difference between their slopes.
+    stack, dates, _, _, _ = synthetic.synthetic_cube(shape, start, end, seed=0)
+    EVI, doy = local_preprocessing.preprocess_Sentinel2(stack, dates)
+    pheno = local_phenology.phenology(EVI, doy)
+    in_season = (doy[:, None, None] >= pheno['SoS']) & (doy[:, None, None] <= pheno['EoS'])
+    EVI = np.where(in_season, EVI, np.nan)
+
+    begin = time.perf_counter()
+    slope, _ = local_trends.theil_sen(EVI, doy)
+    seconds = time.perf_counter() - begin
+    begin = time.perf_counter()
+    reference = brute_force_theil_sen(EVI, doy)
+    brute_force_seconds = time.perf_counter() - begin
+    return {'seconds':seconds, 'brute_force_seconds':brute_force_seconds,
+            'max_difference':float(np.nanmax(np.abs(slope - reference), initial=0))}
+
+def benchmark(n_tiles, shape, start, end, workers, threshold=-0.040, max_size=10):
+    # Runs n_tiles tiles on a pool of the given size. Returns the wall time
+    # of the run and the per-tile results.
+    begin = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_stages, tile, shape, start, end, threshold, max_size)
+                   for tile in range(n_tiles)]
+        results = [future.result() for future in futures]
+    return time.perf_counter() - begin, results
+
+def summarize(results, n_pixels, memory):
+    # Pixels per second for each stage over all tiles, with the peak resident
+    # memory of each stage from measure_memory.
+    summary = {}
+    for stage in stages:
+        seconds = sum(result['seconds'][stage] for result in results)
+        summary[stage] = {'seconds':seconds,
+                          'pixels_per_second':n_pixels * len(results) / seconds if seconds else math.inf,
+                          'peak_rss_mb':memory[stage]['peak_rss_mb'],
+                          'rss_increase_mb':memory[stage]['rss_increase_mb']}
+    return summary
+
+
+if __name__ == '__main__':
+
+    ##############################################################
+    # Parse arguments
+    ##############################################################
+
+    parser = argparse.ArgumentParser(
+        description='Options for benchmarking the local pipeline on synthetic data')
+
+    # The area to benchmark over (in km^2), e.g. 1 for a single
+    # square kilometer up to ~141,300 for New York State.
+    parser.add_argument('--area', '-a', action='store', type=float, default=1)
+
+    # The resolution (in meters) and width/length (in pixels) of tiles.
+    parser.add_argument('--resolution', '-r', action='store', type=float, default=10)
+    parser.add_argument('--tile_size', '-t', action='store', type=int, default=100)
+
+    # The first and last years of the synthetic time series (inclusive).
+    parser.add_argument('--start', '-S', action='store', type=int, default=2019)
+    parser.add_argument('--end', '-E', action='store', type=int, default=2023)
+
+    # The worker counts to measure scaling across.
+    parser.add_argument('--workers', '-w', action='store', type=int, nargs='+', default=[1])
+
+    # The threshold to use for classification.
+    parser.add_argument('--threshold', action='store', type=float, default=-0.040)
+
+    # Width/length (in pixels) of the tile to check the Theil-Sen engine
+    # against brute force on, or 0 to skip the check.
+    parser.add_argument('--check_size', action='store', type=int, default=30)
+
+    # JSON file to write the results to.
+    parser.add_argument('--output', '-o', action='store', default=None)
+
+    args = parser.parse_args()
+
+    ##############################################################
+    # Run benchmark
+    ##############################################################
+
+    tile_area = (args.tile_size * args.resolution / 1000) ** 2
+    n_tiles = max(1, math.ceil(args.area / tile_area))
+    shape = (args.tile_size, args.tile_size)
+    n_pixels = args.tile_size ** 2
+    print(f'{n_tiles} tiles of {args.tile_size}x{args.tile_size} pixels')
+
+    # Peak resident memory of each stage of one tile.
+    memory = measure_memory(shape, args.start, args.end, args.threshold)
+
+    report = {'area':args.area, 'resolution':args.resolution, 'tile_size':args.tile_size,
+              'n_tiles':n_tiles, 'start':args.start, 'end':args.end, 'scaling':[]}
+    for workers in args.workers:
+        seconds, results = benchmark(n_tiles, shape, args.start, args.end, workers,
+                                     args.threshold)
+        throughput = n_pixels * n_tiles / seconds
+        report['scaling'].append({'workers':workers, 'seconds':seconds,
+                                  'pixels_per_second':throughput})
+        print(f'{workers} workers: {seconds:.1f} s, {throughput:,.0f} pixels/s')
+
+        # Stage timings from the single worker run (or the first run).
+        if 'stages' not in report or workers == 1:
+            report['stages'] = summarize(results, n_pixels, memory)
+
+    for stage, summary in report['stages'].items():
+        print(f"{stage:>15}: {summary['pixels_per_second']:>14,.0f} pixels/s, "
+              f"peak RSS {summary['peak_rss_mb']:,.0f} MB "
+              f"(+{summary['rss_increase_mb']:,.0f} MB)")
+
+    if args.check_size > 0:
+        check = check_theil_sen((args.check_size, args.check_size), args.start, args.end)
+        report['theil_sen_check'] = check
+        print(f"Theil-Sen check: {check['seconds']:.2f} s, brute force "
+              f"{check['brute_force_seconds']:.2f} s "
+              f"({check['brute_force_seconds'] / check['seconds']:.1f}x), "
+              f"max slope difference {check['max_difference']:.1e}")
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
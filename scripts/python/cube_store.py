@@ -0,0 +1,193 @@
+##########################################################
+# Chunked, compressed on-disk store for the masked EVI
+# cube (time, y, x) and the doy of each scene, so that
+# scenes are preprocessed once and shared by the maximum
+# separation, trend and defoliation stages.
+#
+# A store is a directory holding cube.json (shape, chunk
+# shape, source, dates and doy) and one zlib compressed,
+# byte-shuffled chunk file per (time, row, col) chunk in
+# EVI/. Chunks that were never written read as NaN.
+##########################################################
+
+import json
+import os
+import zlib
+
+import numpy as np
+import rasterio as rio
+from rasterio.crs import CRS
+from rasterio.transform import Affine
+from rasterio.windows import Window
+
+import local_io
+import local_preprocessing
+import scheduler
+
+# (time, y, x) chunk shape
+CHUNKS = (64, 512, 512)
+
+
+def chunk_key(index):
+    return '.'.join(str(i) for i in index)
+
+def shuffle(block):
+    # Group the n-th byte of every value together, which compresses far
+    # better than interleaved float32 bytes.
+    return block.view(np.uint8).reshape(-1, block.itemsize).T.tobytes()
+
+def unshuffle(data, dtype, shape):
+    dtype = np.dtype(dtype)
+    raw = np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, -1).T
+    return np.ascontiguousarray(raw).view(dtype).reshape(shape)
+
+def overlap(selection, start, size):
+    # Intersection of a selected range with a chunk range, relative to both.
+    first, last = max(selection.start, start), min(selection.stop, start + size)
+    if first >= last:
+        return None, None
+    return (slice(first - selection.start, last - selection.start),
+            slice(first - start, last - start))
+
+
+class CubeStore:
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'cube.json'), 'r') as f:
+            meta = json.load(f)
+        self.path = path
+        self.shape = tuple(meta['shape'])
+        self.chunks = tuple(meta['chunks'])
+        self.source = meta['source']
+        self.level = meta['level']
+        self.dates = np.array(meta['dates'], dtype='datetime64[D]')
+        self.doy = np.array(meta['doy'], dtype=np.uint16)
+        self.properties = meta.get('properties', {})
+        # Georeferencing of the scenes, if known when the store was created.
+        self.crs = meta.get('crs')
+        self.transform = Affine(*meta['transform']) if meta.get('transform') else None
+
+    def chunk_path(self, index):
+        return os.path.join(self.path, 'EVI', chunk_key(index))
+
+    def chunk_shape(self, index):
+        return tuple(min(chunk, size - i * chunk)
+                     for i, chunk, size in zip(index, self.chunks, self.shape))
+
+    def chunk_indexes(self, times, rows, cols):
+        # Indexes of every chunk overlapping the selection.
+        ranges = [range(s.start // chunk, -(-s.stop // chunk))
+                  for s, chunk in zip([times, rows, cols], self.chunks)]
+        for t in ranges[0]:
+            for y in ranges[1]:
+                for x in ranges[2]:
+                    yield (t, y, x)
+
+    def has_chunk(self, index):
+        return os.path.exists(self.chunk_path(index))
+
+    def write_chunk(self, index, block):
+        # Writes to a temporary file first so a chunk is never half written.
+        assert block.shape == self.chunk_shape(index), f"Chunk {index} must be {self.chunk_shape(index)}."
+        block = np.ascontiguousarray(block, dtype=np.float32)
+        path = self.chunk_path(index)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(zlib.compress(shuffle(block), self.level))
+        os.replace(path + '.tmp', path)
+
+    def read_chunk(self, index):
+        if not self.has_chunk(index):
+            return None
+        with open(self.chunk_path(index), 'rb') as f:
+            return unshuffle(zlib.decompress(f.read()), np.float32, self.chunk_shape(index))
+
+    def write(self, EVI, time_start=0, row_start=0, col_start=0):
+        # Writes a (time, y, x) block whose start is aligned to the chunk grid.
+        starts = (time_start, row_start, col_start)
+        assert all(s % c == 0 for s, c in zip(starts, self.chunks)), "Block must start on a chunk boundary."
+        selection = [slice(s, s + n) for s, n in zip(starts, EVI.shape)]
+        for index in self.chunk_indexes(*selection):
+            chunk_start = [i * c for i, c in zip(index, self.chunks)]
+            parts = [slice(c - s, c - s + n)
+                     for c, s, n in zip(chunk_start, starts, self.chunk_shape(index))]
+            self.write_chunk(index, EVI[tuple(parts)])
+
+    def read(self, times=slice(None), rows=slice(None), cols=slice(None), phenology=None):
+        # Reads a (time, y, x) selection, touching only the chunks it overlaps.
+        # With phenology ({'SoS':..., 'EoS':...} for the selected pixels),
+        # observations outside the season are masked as in preprocessing.
+        times, rows, cols = [slice(*s.indices(n)[:2]) for s, n in zip([times, rows, cols], self.shape)]
+        shape = tuple(s.stop - s.start for s in [times, rows, cols])
+        EVI = np.full(shape, np.nan, dtype=np.float32)
+        for index in self.chunk_indexes(times, rows, cols):
+            block = self.read_chunk(index)
+            if block is None:
+                continue
+            parts = [overlap(s, i * c, n) for s, i, c, n
+                     in zip([times, rows, cols], index, self.chunks, block.shape)]
+            out, src = zip(*parts)
+            EVI[out] = block[src]
+
+        if phenology is not None:
+            doy = self.doy[times][:, None, None]
+            EVI[(doy < phenology['SoS']) | (doy > phenology['EoS'])] = np.nan
+        return EVI, self.doy[times]
+
+    def scenes(self, rows=slice(None), cols=slice(None)):
+        # Streams (date, doy, EVI) scenes for a window, one time chunk at a time,
+        # e.g. for local_defoliation.defoliation.
+        for start in range(0, self.shape[0], self.chunks[0]):
+            times = slice(start, min(start + self.chunks[0], self.shape[0]))
+            EVI, doy = self.read(times, rows, cols)
+            for t in range(EVI.shape[0]):
+                yield self.dates[start + t], doy[t], EVI[t]
+
+
+def create(path, dates, source, shape, chunks=CHUNKS, level=1, properties=None,
+           crs=None, transform=None):
+    # Creates an empty store for len(dates) scenes of shape (y, x), with the
+    # CRS (WKT or authority string) and affine transform of the scenes.
+    os.makedirs(os.path.join(path, 'EVI'), exist_ok=True)
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    doy = local_preprocessing.day_of_year(dates, local_preprocessing.doy_offsets[source])
+    meta = {'shape':[len(dates)] + list(shape), 'chunks':list(chunks), 'source':source,
+            'level':level, 'dates':[str(date) for date in dates],
+            'doy':doy.tolist(), 'properties':properties or {},
+            'crs':None if crs is None else CRS.from_user_input(crs).to_wkt(),
+            'transform':None if transform is None else list(transform)[:6]}
+    with open(os.path.join(path, 'cube.json'), 'w') as f:
+        json.dump(meta, f)
+    return CubeStore(path)
+
+
+##################################################################
+# Preprocessing scenes into a store
+##################################################################
+
+def preprocess_chunk(key, path, paths):
+    # Reads the scenes of one (time, row, col) chunk from disk, preprocesses
+    # them and writes the masked EVI to the store.
+    store = CubeStore(path)
+    index = tuple(int(i) for i in key.split('.'))
+    if store.has_chunk(index):
+        return key
+    n_time, height, width = store.chunk_shape(index)
+    start = [i * c for i, c in zip(index, store.chunks)]
+    times = slice(start[0], start[0] + n_time)
+    window = Window(start[2], start[1], width, height)
+    stack = local_io.read_stack(paths[times], local_preprocessing.bands[store.source], window)
+    EVI, _ = local_preprocessing.preprocess(stack, store.dates[times], store.source)
+    store.write_chunk(index, EVI)
+    return key
+
+def build(path, paths, dates, source, shape, chunks=CHUNKS, workers=os.cpu_count()):
+    # Preprocesses every scene once into a store. Finished chunks are kept
+    # in a ledger, so an interrupted build resumes where it stopped.
+    with rio.open(paths[0]) as src:
+        crs, transform = src.crs, src.transform
+    store = create(path, dates, source, shape, chunks, crs=crs, transform=transform)
+    keys = [chunk_key(index) for index in store.chunk_indexes(
+        *[slice(0, n) for n in store.shape])]
+    failed = scheduler.run_tiles(preprocess_chunk, keys, os.path.join(path, 'ledger.jsonl'),
+                                 workers=workers, args=(path, np.asarray(paths)))
+    return store, failed
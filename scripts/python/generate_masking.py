@@ -4,7 +4,7 @@
 
 import argparse
 import geometries
-import time
+import scheduler
 
 parser = argparse.ArgumentParser(
     description='Options for calculating seasonal trends')
@@ -12,12 +12,18 @@ parser = argparse.ArgumentParser(
 # The script will ONLY submit the run when -s or --submit is included.
 parser.add_argument('--submit', '-s', action='store_true')
 
+scheduler.add_arguments(parser)
+
 # The project to submit the code in. You may be prompted to to authenticate.
 parser.add_argument('--project', '-p', action='store', default=None, required=True)
 
 # The year to create a qa mask for.
 parser.add_argument('--year', '-S', action='store', type=int, default=2019)
 
+# The first and last years (inclusive) the preseason maximum is taken over.
+parser.add_argument('--reference_start', action='store', type=int, default=2019)
+parser.add_argument('--reference_end', action='store', type=int, default=2024)
+
 # The geomtry to calculate defoliation within. A list of valid geometries are available in scripts/geometries.py
 parser.add_argument('--geometry', '-g', action='store', default='Mt_Pleasant', choices=geometries.site_names)
 
@@ -94,14 +100,20 @@ grid = geometry.coveringGrid(proj)
 gridSize = grid.size().getInfo()
 gridList = grid.toList(gridSize)
 
-for i in range(gridSize):
-  
-    gridCell = ee.Feature(gridList.get(i)).geometry()
+if not args.submit:
+    # Plan the run and exit instead of exporting.
+    import planner
+    years = sorted({args.year, *range(args.reference_start, args.reference_end + 1)})
+    planner.run(args, grid, 'Sentinel2', 10, years, ['preprocessing'], written_per_run=4 * 2)
 
-    # Cloud mask parameters
-    csPlus = ee.ImageCollection('GOOGLE/CLOUD_SCORE_PLUS/V1/S2_HARMONIZED')
-    QA_BAND = 'cs_cdf'
-    CLEAR_THRESHOLD = 0.65
+# Cloud mask parameters, also used by preprocess
+csPlus = ee.ImageCollection('GOOGLE/CLOUD_SCORE_PLUS/V1/S2_HARMONIZED')
+QA_BAND = 'cs_cdf'
+CLEAR_THRESHOLD = 0.65
+
+def make_task(i):
+    # The export task of tile i, started by scheduler.run_tasks.
+    gridCell = ee.Feature(gridList.get(i)).geometry()
 
     # Create yearly observation mask
     def yearly_obs_mask(year, threshold):
@@ -137,7 +149,8 @@ for i in range(gridSize):
     ## All years images
     s2_all_years = (ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED')
             .filterBounds(gridCell)
-            .filterDate('2019-01-01', '2025-01-01')
+            .filterDate(ee.Date.fromYMD(args.reference_start, 1, 1),
+                        ee.Date.fromYMD(args.reference_end + 1, 1, 1))
             .linkCollection(csPlus, [QA_BAND])
             .map(preprocess));
 
@@ -171,22 +184,29 @@ for i in range(gridSize):
                         weak_obs_mask.rename('count_2')])
     
     # Create Task
-    if args.submit:
-        if gridSize > 1:
-            imageName = f'{assetID}_tile_{i}'
-            description = f'{description}_tile_{i}'
-        else:
-            imageName = assetID
-            description = description
-            
-        task = ee.batch.Export.image.toAsset(
-            image            = qa_mask,
-            description      = description,
-            assetId          = imageName,
-            region           = gridCell,
-            scale            = 10,
-            crs              = args.crs,
-            pyramidingPolicy = {'.default': 'mean'},
-            maxPixels        = 1e10
-        )
-        task.start()
\ No newline at end of file
+    if gridSize > 1:
+        imageName = f'{assetID}_tile_{i}'
+        task_description = f'{description}_tile_{i}'
+    else:
+        imageName = assetID
+        task_description = description
+        
+    task = ee.batch.Export.image.toAsset(
+        image            = qa_mask,
+        description      = task_description,
+        assetId          = imageName,
+        region           = gridCell,
+        scale            = 10,
+        crs              = args.crs,
+        pyramidingPolicy = {'.default': 'mean'},
+        maxPixels        = 1e10
+    )
+    return task
+
+##################################################################
+# Submit every tile, skipping those finished in a previous run
+##################################################################
+
+scheduler.run_tasks(make_task, list(range(gridSize)),
+                    args.ledger or f'{description}_{args.year}_tiles.jsonl',
+                    max_in_flight=args.max_in_flight)
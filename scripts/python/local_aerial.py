@@ -0,0 +1,166 @@
+##########################################################
+# Local replacement for aerial_comparison.py. Aerial
+# survey polygons are rasterized onto the grid of each
+# year's defoliation map, the labelled pixels are gathered
+# tile by tile, and one sort by (polygon, mean_intensity)
+# gives every percentile of every polygon at once.
+##########################################################
+
+import argparse
+import csv
+import json
+
+import numpy as np
+import rasterio as rio
+from rasterio import features
+from rasterio.warp import transform_geom
+from rasterio.windows import Window
+
+import local_denoise
+import local_io
+import local_zonal
+
+percentiles = [10, 29, 50]
+
+
+def read_survey(path):
+    # Properties and geometries (EPSG:4326) of the aerial survey polygons.
+    with open(path, 'r') as f:
+        collection = json.load(f)
+    properties = [feature['properties'] for feature in collection['features']]
+    geometries = [feature['geometry'] for feature in collection['features']]
+    return properties, geometries
+
+def overlap_layers(bounds):
+    # Splits polygons into layers whose bounding boxes do not overlap, so
+    # that each layer can be rasterized to one label raster while every
+    # polygon keeps all of its pixels. Survey polygons rarely overlap within
+    # a year, so this is usually a single layer.
+    layers, layer_bounds = [], []
+    for i in np.argsort(bounds[:, 0], kind='stable'):
+        for layer, members in zip(layers, layer_bounds):
+            others = np.array(members)
+            if not ((others[:, 0] < bounds[i, 2]) & (others[:, 2] > bounds[i, 0])
+                    & (others[:, 1] < bounds[i, 3]) & (others[:, 3] > bounds[i, 1])).any():
+                layer.append(i)
+                members.append(bounds[i])
+                break
+        else:
+            layers.append([i])
+            layer_bounds.append([bounds[i]])
+    return layers
+
+def gather_pixels(path, geometries, band='mean_intensity', tile_size=4096):
+    # Polygon index and value of every valid pixel whose centre lies in a
+    # polygon, read tile by tile over the window covering the polygons.
+    with rio.open(path) as src:
+        shapes = [transform_geom('EPSG:4326', src.crs, geometry) for geometry in geometries]
+        bounds = np.array([features.bounds(shape) for shape in shapes])
+        window = local_zonal.grid_window(src, geometries)
+        labels, values = [], []
+        for rows, cols in local_denoise.tiles((int(window.height), int(window.width)), tile_size):
+            tile = Window(window.col_off + cols.start, window.row_off + rows.start,
+                          cols.stop - cols.start, rows.stop - rows.start)
+            transform = src.window_transform(tile)
+            left, top = transform * (0, 0)
+            right, bottom = transform * (tile.width, tile.height)
+            in_tile = np.flatnonzero((bounds[:, 0] < right) & (bounds[:, 2] > left)
+                                     & (bounds[:, 1] < top) & (bounds[:, 3] > bottom))
+            if in_tile.size == 0:
+                continue
+
+            image = local_io.read_band(src, band, tile)
+            for layer in overlap_layers(bounds[in_tile]):
+                label = features.rasterize(((shapes[i], i) for i in in_tile[layer]),
+                                           out_shape=image.shape, transform=transform,
+                                           fill=-1, dtype='int32')
+                valid = (label >= 0) & ~np.isnan(image)
+                labels.append(label[valid])
+                values.append(image[valid])
+    if not labels:
+        return np.zeros(0, dtype=np.int32), np.zeros(0)
+    return np.concatenate(labels), np.concatenate(values)
+
+def grouped_percentiles(labels, values, n_labels, percentile_values):
+    # Percentiles (n_labels, percentiles) of the values of each label, with
+    # linear interpolation as np.percentile, NaN for labels without pixels.
+    order = np.lexsort((values, labels))
+    values = values[order]
+    counts = np.bincount(labels, minlength=n_labels)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+    position = (counts[:, None] - 1) * np.asarray(percentile_values, dtype=np.float64)[None] / 100
+    lower = np.floor(position).astype(np.int64)
+    upper = np.ceil(position).astype(np.int64)
+    empty = counts == 0
+    lower[empty], upper[empty] = 0, 0
+    if values.size == 0:
+        return np.full(position.shape, np.nan)
+    lower_values = values[np.minimum(starts[:, None] + lower, values.size - 1)]
+    upper_values = values[np.minimum(starts[:, None] + upper, values.size - 1)]
+    result = lower_values + (upper_values - lower_values) * (position - lower)
+    result[empty] = np.nan
+    return result
+
+def survey_percentiles(maps, properties, geometries, percentile_values=percentiles,
+                       band='mean_intensity', tile_size=4096):
+    # Rows of the validation table for every polygon of every year with a
+    # defoliation map ({year: path}), with columns p{percentile}.
+    years = np.array([int(feature['year']) for feature in properties])
+    rows = []
+    for year, path in maps.items():
+        selected = np.flatnonzero(years == year)
+        if selected.size == 0:
+            continue
+        labels, values = gather_pixels(path, [geometries[i] for i in selected], band, tile_size)
+        result = grouped_percentiles(labels, values, selected.size, percentile_values)
+        for i, polygon in enumerate(selected):
+            row = dict(properties[polygon])
+            for p, value in zip(percentile_values, result[i]):
+                row[f'p{p:g}'] = None if np.isnan(value) else float(value)
+            rows.append(row)
+    return rows
+
+
+if __name__ == '__main__':
+
+    ##############################################################
+    # Parse arguments
+    ##############################################################
+
+    parser = argparse.ArgumentParser(
+        description='Options for comparing defoliation scores with aerial surveys')
+
+    # Aerial survey polygons as GeoJSON, with year and PCT_AFFECT properties.
+    parser.add_argument('--survey', '-s', action='store', required=True)
+
+    # Defoliation maps with a mean_intensity band, one for each of --years.
+    parser.add_argument('--maps', '-m', action='store', nargs='+', required=True)
+
+    # Survey year of each map.
+    parser.add_argument('--years', '-y', action='store', nargs='+', type=int, default=[2021])
+
+    # Percentiles of mean_intensity to calculate for each polygon.
+    parser.add_argument('--percentiles', '-p', action='store', nargs='+', type=float,
+                        default=percentiles)
+
+    # Output table.
+    parser.add_argument('--output', '-o', action='store', default='validation.csv')
+
+    args = parser.parse_args()
+
+    ##############################################################
+    # Calculate percentiles
+    ##############################################################
+
+    assert len(args.maps) == len(args.years), "Expected one survey year for each map."
+    properties, geometries = read_survey(args.survey)
+    rows = survey_percentiles(dict(zip(args.years, args.maps)), properties, geometries,
+                              args.percentiles)
+
+    selectors = ['year', 'PCT_AFFECT'] + [f'p{p:g}' for p in args.percentiles]
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=selectors, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f'Wrote {len(rows)} polygons to {args.output}')
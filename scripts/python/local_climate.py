@@ -0,0 +1,158 @@
+##########################################################
+# Local replacement for gridded_precipitation.js and
+# gridded_temperature.js. Daymet NetCDF files are read
+# once, every daily image is reduced to the mean of each
+# 10 km grid cell, and all monthly *_mean, *_recent,
+# *_anom and days columns are computed from cumulative
+# sums over day of year (climatology) and over time
+# (recent period).
+##########################################################
+
+import argparse
+import os
+
+import numpy as np
+import rasterio as rio
+
+import local_preprocessing
+import local_zonal
+
+# Daymet stores time as days since this date unless the file says otherwise.
+DAYMET_EPOCH = '1950-01-01'
+
+
+##################################################################
+# Reading Daymet
+##################################################################
+
+def daymet_dates(src):
+    units = src.tags().get('time#units', f'days since {DAYMET_EPOCH}')
+    epoch = np.datetime64(units.split('since ')[1].split(' ')[0].split('T')[0], 'D')
+    times = np.array([float(src.tags(band)['NETCDF_DIM_time']) for band in src.indexes])
+    return epoch + np.floor(times).astype('timedelta64[D]')
+
+def read_daymet(paths, variable, ids, geometries, block_bands=32):
+    # Daily grid cell means of a Daymet variable (time, zone) from a stack of
+    # NetCDF files on the same grid, sorted by date. Only the window covering
+    # the grid is read, and the zone raster is built once.
+    dates, daily = [], []
+    zones = window = None
+    for path in paths:
+        with rio.open(f'netcdf:{path}:{variable}') as src:
+            if zones is None:
+                window = local_zonal.grid_window(src, geometries)
+                zones = local_zonal.rasterize_zones(
+                    geometries, (int(window.height), int(window.width)),
+                    src.window_transform(window), src.crs)
+            dates.append(daymet_dates(src))
+            for start in range(0, src.count, block_bands):
+                indexes = list(src.indexes[start:start + block_bands])
+                values = src.read(indexes, window=window).astype(np.float32)
+                if src.nodata is not None:
+                    values[values == src.nodata] = np.nan
+                daily.append(local_zonal.zonal_means(values, zones, len(ids)))
+    dates, daily = np.concatenate(dates), np.concatenate(daily)
+    order = np.argsort(dates, kind='stable')
+    return dates[order], daily[order]
+
+
+##################################################################
+# Monthly windows and anomalies
+##################################################################
+
+def month_windows(target_year, n_months=24):
+    # Start and end dates, day of year range and day count of each month
+    # before 1 June of the target year, defined as in the gridded_*.js
+    # scripts (days = end_doy - start_doy + 2, and the December window
+    # wraps to day of year 0).
+    start_of_defol = np.datetime64(f'{target_year}-06', 'M')
+    windows = []
+    for month in range(1, n_months + 1):
+        start = (start_of_defol - month).astype('datetime64[D]')
+        end = (start_of_defol - (month - 1)).astype('datetime64[D]')
+        start_doy = int(local_preprocessing.day_of_year(start, offset=1))
+        end_doy = int(local_preprocessing.day_of_year(end, offset=0))
+        windows.append({'month':month, 'start':start, 'end':end, 'start_doy':start_doy,
+                        'end_doy':end_doy, 'days':end_doy - start_doy + 2})
+    return windows
+
+def doy_cumsum(dates, daily):
+    # Cumulative sums over day of year (1..366) of the daily values of all
+    # years, with a leading zero row.
+    doy = local_preprocessing.day_of_year(dates, offset=1)
+    by_doy = np.zeros((367, daily.shape[1]))
+    np.add.at(by_doy, doy, daily)
+    return np.cumsum(by_doy, axis=0)
+
+def doy_window_sum(cumsum, start_doy, end_doy):
+    # Sum over days of year start_doy..end_doy, wrapping around the year
+    # when end_doy < start_doy (as ee.Filter.dayOfYear).
+    if start_doy <= end_doy:
+        return cumsum[end_doy] - cumsum[start_doy - 1]
+    return cumsum[-1] - cumsum[start_doy - 1] + cumsum[end_doy]
+
+def monthly_anomalies(dates, daily, variable, target_year, n_months=24):
+    # Columns {variable}_mean_m, {variable}_recent_m, {variable}_anom_m and
+    # days for every month m before the target season, for every zone.
+    years = dates.astype('datetime64[Y]')
+    n_years = len(np.unique(years))
+    climatology = doy_cumsum(dates, daily)
+    over_time = np.zeros((len(dates) + 1, daily.shape[1]))
+    np.cumsum(daily, axis=0, out=over_time[1:])
+
+    outputs = {}
+    for window in month_windows(target_year, n_months):
+        month = window['month']
+        mean = doy_window_sum(climatology, window['start_doy'], window['end_doy']) / n_years
+        first, last = np.searchsorted(dates, [window['start'], window['end']])
+        recent = over_time[last] - over_time[first]
+        outputs[month] = {f'{variable}_mean_{month}':mean,
+                          f'{variable}_recent_{month}':recent,
+                          f'{variable}_anom_{month}':recent - mean,
+                          'days':np.full(mean.shape, window['days'])}
+    return outputs
+
+
+if __name__ == '__main__':
+
+    ##############################################################
+    # Parse arguments
+    ##############################################################
+
+    parser = argparse.ArgumentParser(
+        description='Options for calculating gridded climate anomalies from Daymet')
+
+    # Daymet NetCDF files (e.g. one per year from 1980 to 2023).
+    parser.add_argument('--daymet', '-d', action='store', nargs='+', required=True)
+
+    # The 10 km grid as GeoJSON, e.g. an export of gridded_defoliation.js.
+    parser.add_argument('--grid', '-g', action='store', required=True)
+
+    # The year of defoliation to calculate anomalies before.
+    parser.add_argument('--year', '-y', action='store', type=int, default=2021)
+
+    # Daymet variables to calculate anomalies for.
+    parser.add_argument('--variables', '-v', action='store', nargs='+',
+                        default=['prcp', 'tmax'])
+
+    # Number of months before the start of defoliation.
+    parser.add_argument('--months', '-m', action='store', type=int, default=24)
+
+    # Folder to write {variable}_grid_{year}_month_{m}.geojson files to.
+    parser.add_argument('--output', '-o', action='store', default='.')
+
+    args = parser.parse_args()
+
+    ##############################################################
+    # Calculate anomalies
+    ##############################################################
+
+    ids, geometries = local_zonal.read_grid(args.grid)
+    os.makedirs(args.output, exist_ok=True)
+    for variable in args.variables:
+        dates, daily = read_daymet(args.daymet, variable, ids, geometries)
+        outputs = monthly_anomalies(dates, daily, variable, args.year, args.months)
+        for month, columns in outputs.items():
+            path = os.path.join(args.output, f'{variable}_grid_{args.year}_month_{month}.geojson')
+            local_zonal.write_grid(path, ids, geometries, columns)
+        print(f'Wrote {len(outputs)} {variable} grids for {args.year}')
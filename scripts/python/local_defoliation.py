@@ -0,0 +1,92 @@
+##########################################################
+# Local (NumPy) defoliation scores, as in
+# 2_1_defoliation_theilsen.py, computed for every year in
+# a single pass over the scenes of a tile.
+##########################################################
+
+import numpy as np
+
+import local_io
+import local_preprocessing
+import local_trends
+
+# Window (day of year, inclusive) used to estimate defoliation.
+SUMMER_START = 161
+SUMMER_END = 208
+
+
+def decompress_models(bands, properties, mask=None):
+    # Uncompress the uint16 Theil-Sen models written by 1_1_trends_theilsen.py,
+    # NaN where the (optional) mask read with them is False.
+    slope = local_trends.decompress(bands['slope'], float(properties['min_slope']),
+                                    float(properties['max_slope']))
+    offset = local_trends.decompress(bands['offset'], float(properties['min_intercept']),
+                                     float(properties['max_intercept']))
+    if mask is not None:
+        slope[~mask] = np.nan
+        offset[~mask] = np.nan
+    return slope, offset
+
+def accumulate_anomalies(EVI, dates, doy, slope, offset, start, end, sums=None, counts=None):
+    # Adds the summer anomalies of a batch of scenes, EVI (time, y, x) with
+    # NaN for masked pixels, to per-year sums and counts shaped
+    # (year, y, x) for the years start..end.
+    if sums is None:
+        shape = (end - start + 1,) + slope.shape
+        sums = np.zeros(shape, dtype=np.float32)
+        counts = np.zeros(shape, dtype=np.uint16)
+
+    years = np.asarray(dates, dtype='datetime64[Y]').astype(np.int64) + 1970
+    calendar_doy = local_preprocessing.day_of_year(dates, offset=1)
+    in_window = ((calendar_doy >= SUMMER_START) & (calendar_doy <= SUMMER_END)
+                 & (years >= start) & (years <= end))
+
+    anom = np.empty(slope.shape, dtype=np.float32)
+    valid = np.empty(slope.shape, dtype=bool)
+    for t in np.flatnonzero(in_window):
+        i = years[t] - start
+        # anom = EVI - (slope * doy + offset)
+        np.multiply(slope, np.float32(doy[t]), out=anom)
+        anom += offset
+        np.subtract(EVI[t], anom, out=anom)
+        np.equal(anom, anom, out=valid)
+        np.add(sums[i], anom, out=sums[i], where=valid)
+        counts[i] += valid
+    return sums, counts
+
+def mean_intensity(sums, counts):
+    # Mean summer anomaly for each year, NaN where there were no observations.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return sums / counts
+
+def defoliation(scenes, models, properties, start, end):
+    # Defoliation scores for every year from start to end (inclusive) from
+    # one pass over a stream of (date, doy, EVI) scenes. Models are the
+    # compressed slope/offset bands, decompressed once for the tile.
+    slope, offset = decompress_models(models, properties)
+    sums = counts = None
+    for date, doy, EVI in scenes:
+        sums, counts = accumulate_anomalies(EVI[None], [date], [doy], slope, offset,
+                                            start, end, sums, counts)
+    if sums is None:
+        shape = (end - start + 1,) + slope.shape
+        return np.full(shape, np.nan, dtype=np.float32)
+    return mean_intensity(sums, counts)
+
+def compress_defoliation(scores, start, end, minimum=-1, maximum=1):
+    # Returns the uint16 mean_intensity band, properties and mask of pixels
+    # with a score for each year, as exported by 2_1_defoliation_theilsen.py.
+    # compress stores NaN as 0 (the minimum once decompressed), so the mask
+    # has to be written with the band.
+    outputs = {}
+    for i, year in enumerate(range(start, end + 1)):
+        bands = {'mean_intensity':local_trends.compress(scores[i], minimum, maximum)}
+        properties = {'start':start, 'end':end, 'min':minimum, 'max':maximum, 'year':year}
+        outputs[year] = (bands, properties, ~np.isnan(scores[i]))
+    return outputs
+
+def write_defoliation(path, scores, start, end, profile):
+    # Writes the compressed scores of each year to a COG, path formatted
+    # with the year, masked where there is no score.
+    for year, (bands, properties, mask) in compress_defoliation(scores, start, end).items():
+        local_io.write_bands(path.format(year=year), bands, profile, properties, mask=mask)
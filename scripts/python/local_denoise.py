@@ -0,0 +1,93 @@
+##########################################################
+# Local removal of small defoliation patches, as in
+# 3_classify_denoise.py, with exact patch sizes.
+#
+# Rasters are processed tile by tile. Each tile keeps a
+# one pixel halo of edge labels, which are merged across
+# tile seams so that patch sizes are exact over the whole
+# raster while memory is bounded by the tile size.
+##########################################################
+
+import numpy as np
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+# connectedPixelCount(..., eightConnected=False) uses 4-connectivity.
+FOUR_CONNECTED = ndimage.generate_binary_structure(2, 1)
+
+
+def tiles(shape, tile_size):
+    height, width = shape
+    for row in range(0, height, tile_size):
+        for col in range(0, width, tile_size):
+            yield (slice(row, min(row + tile_size, height)),
+                   slice(col, min(col + tile_size, width)))
+
+def label_tile(classes):
+    return ndimage.label(classes, structure=FOUR_CONNECTED)
+
+def patch_sizes(read_tile, shape, tile_size=4096):
+    # First pass: label every tile, record the label offset of each tile,
+    # and merge labels that touch across tile seams. Returns the offsets
+    # and the size of the full patch for every global label.
+    offsets = {}
+    halos = {}
+    sizes = [np.zeros(1, dtype=np.int64)]
+    n_labels = 1
+    for rows, cols in tiles(shape, tile_size):
+        labels, n = label_tile(read_tile(rows, cols))
+        sizes.append(np.bincount(labels.ravel(), minlength=n + 1)[1:])
+
+        offset = n_labels - 1
+        offsets[rows.start, cols.start] = offset
+        halos[rows.start, cols.start] = {
+            edge: np.where(pixels > 0, pixels + offset, 0)
+            for edge, pixels in [('top', labels[0]), ('bottom', labels[-1]),
+                                 ('left', labels[:, 0]), ('right', labels[:, -1])]}
+        n_labels += n
+    sizes = np.concatenate(sizes)
+
+    # Pair labels on either side of each seam.
+    first, second = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    for (row, col), halo in halos.items():
+        below = halos.get((row + tile_size, col))
+        if below is not None:
+            first.append(halo['bottom'])
+            second.append(below['top'])
+        right = halos.get((row, col + tile_size))
+        if right is not None:
+            first.append(halo['right'])
+            second.append(right['left'])
+    first, second = np.concatenate(first), np.concatenate(second)
+    touching = (first > 0) & (second > 0)
+    first, second = first[touching], second[touching]
+
+    # Labels connected across seams belong to the same patch.
+    graph = coo_matrix((np.ones(first.size, dtype=np.int8), (first, second)),
+                       shape=(n_labels, n_labels))
+    _, patches = connected_components(graph, directed=False)
+    patch_size = np.bincount(patches, weights=sizes).astype(np.int64)
+    return offsets, patch_size[patches]
+
+def denoise(read_tile, write_tile, shape, tile_size=4096, max_size=10):
+    # Removes pixels that are part of patches of max_size pixels or fewer.
+    # read_tile(rows, cols) returns the boolean classification for a tile
+    # and write_tile(rows, cols, array) stores the denoised uint8 tile.
+    offsets, sizes = patch_sizes(read_tile, shape, tile_size)
+
+    # Second pass: relabel each tile and keep pixels in large patches.
+    for rows, cols in tiles(shape, tile_size):
+        labels, _ = label_tile(read_tile(rows, cols))
+        global_labels = np.where(labels > 0, labels + offsets[rows.start, cols.start], 0)
+        write_tile(rows, cols, (sizes[global_labels] > max_size).astype(np.uint8))
+
+def denoise_array(classes, tile_size=4096, max_size=10):
+    # Convenience wrapper for classifications already in memory.
+    denoised = np.zeros(classes.shape, dtype=np.uint8)
+    def read_tile(rows, cols):
+        return classes[rows, cols]
+    def write_tile(rows, cols, array):
+        denoised[rows, cols] = array
+    denoise(read_tile, write_tile, classes.shape, tile_size, max_size)
+    return denoised
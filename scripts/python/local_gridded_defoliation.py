@@ -0,0 +1,89 @@
+##########################################################
+# Local replacement for gridded_defoliation.js: forest,
+# deciduous and defoliated area for every 10 km grid cell,
+# from a local NLCD landcover raster and a scores_mask
+# raster, written directly as the joined forest_grid table.
+##########################################################
+
+import argparse
+
+import numpy as np
+import rasterio as rio
+
+import local_io
+import local_zonal
+
+# NLCD classes
+DECIDUOUS = 41
+FOREST_CLASSES = (41, 43) # Deciduous, evergreen and mixed forest
+
+defoliation_bands = ['score_2', 'qa_mask_2', 'score_3', 'qa_mask_3']
+
+# Output column for each band of the scores_mask images.
+defoliation_columns = {'score_2':'defoliation_2', 'qa_mask_2':'qa_mask_2',
+                       'score_3':'defoliation_3', 'qa_mask_3':'qa_mask_3'}
+
+
+def forest_layers(block):
+    landcover = block[0]
+    forest = (landcover >= FOREST_CLASSES[0]) & (landcover <= FOREST_CLASSES[1])
+    return {'forest':forest.astype(np.float64), 'deciduous':(landcover == DECIDUOUS).astype(np.float64)}
+
+def defoliation_layers(block):
+    return {defoliation_columns[band]: block[i] for i, band in enumerate(defoliation_bands)}
+
+def gridded_defoliation(landcover_path, defoliation_path, geometries, zones_path=None, tile_size=4096):
+    # Columns of the forest_grid table for every grid cell. zones_path
+    # caches the zone raster of the defoliation grid, so it is only
+    # rasterized once for all years.
+    n_zones = len(geometries)
+    forest, _ = local_zonal.raster_zonal_sums(landcover_path, geometries, forest_layers,
+                                             indexes=[1], tile_size=tile_size)
+    with rio.open(defoliation_path) as src:
+        indexes = local_io.band_indexes(src, defoliation_bands)
+    defoliation, _ = local_zonal.raster_zonal_sums(defoliation_path, geometries, defoliation_layers,
+                                                  indexes=indexes, zones_path=zones_path,
+                                                  tile_size=tile_size)
+    columns = {}
+    for name in ['forest', 'deciduous']:
+        columns[name] = forest.get(name, np.zeros(n_zones))
+    for name in defoliation_columns.values():
+        columns[name] = defoliation.get(name, np.zeros(n_zones))
+    return columns
+
+
+if __name__ == '__main__':
+
+    ##############################################################
+    # Parse arguments
+    ##############################################################
+
+    parser = argparse.ArgumentParser(
+        description='Options for calculating gridded forest and defoliation area')
+
+    # NLCD 2019 landcover raster.
+    parser.add_argument('--landcover', '-l', action='store', required=True)
+
+    # scores_mask raster for the year (bands score_2, qa_mask_2, score_3, qa_mask_3).
+    parser.add_argument('--defoliation', '-d', action='store', required=True)
+
+    # The 10 km grid as GeoJSON, with an id for each cell.
+    parser.add_argument('--grid', '-g', action='store', required=True)
+
+    # Zone raster aligned with the defoliation rasters, created if missing
+    # and reused for every year.
+    parser.add_argument('--zones', '-z', action='store', default=None)
+
+    # The output table, e.g. forest_grid_2021.geojson.
+    parser.add_argument('--output', '-o', action='store', required=True)
+
+    args = parser.parse_args()
+
+    ##############################################################
+    # Calculate gridded statistics
+    ##############################################################
+
+    ids, geometries = local_zonal.read_grid(args.grid)
+    columns = gridded_defoliation(args.landcover, args.defoliation, geometries, args.zones)
+    local_zonal.write_grid(args.output, ids, geometries, columns)
+    print(f'Wrote {len(ids)} grid cells to {args.output}')
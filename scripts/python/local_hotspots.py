@@ -0,0 +1,165 @@
+##########################################################
+# Local replacement for the reduceToVectors calls in
+# data_wrangling/hotspot_visual.py. The window of each
+# region is read from the defoliation raster once for all
+# thresholds; the thresholded pixels are labelled, the
+# component sizes come from one bincount, and only the
+# components asked for (the largest N, or those above an
+# area) are polygonized.
+##########################################################
+
+import argparse
+import os
+
+import geopandas as gpd
+import numpy as np
+import rasterio as rio
+from rasterio import features
+from rasterio.errors import WindowError
+from scipy import ndimage
+from shapely.geometry import shape
+from shapely.ops import unary_union
+
+import local_io
+import local_zonal
+
+# reduceToVectors connects pixels in all eight directions by default.
+EIGHT_CONNECTED = ndimage.generate_binary_structure(2, 2)
+
+THRESHOLD = -0.2
+
+# Regions of hotspot_visual.py, as lon/lat corners.
+regions = {'mt_pleasant':[-76.38845246824344, 42.46436087095481,
+                          -76.37167256864628, 42.46436087095481,
+                          -76.37167256864628, 42.47417424877469,
+                          -76.38845246824344, 42.47417424877469],
+           'positive':[-76.41623453360863, 42.41051611482946,
+                       -76.37769655448265, 42.41051611482946,
+                       -76.37769655448265, 42.430158205380344,
+                       -76.41623453360863, 42.430158205380344],
+           'negative':[-74.62383683191842, 43.046694487257746,
+                       -74.61315091120309, 43.046694487257746,
+                       -74.61315091120309, 43.05230810581971,
+                       -74.62383683191842, 43.05230810581971]}
+
+
+def region_geometry(coordinates):
+    # GeoJSON polygon from a flat list of corners, as ee.Geometry.Polygon.
+    ring = [coordinates[i:i + 2] for i in range(0, len(coordinates), 2)]
+    return {'type':'Polygon', 'coordinates':[ring + [ring[0]]]}
+
+def components(mask, areas):
+    # 8-connected components of a mask, with the pixel count and area of
+    # each label (label 0 is the background).
+    labels, n = ndimage.label(mask, structure=EIGHT_CONNECTED)
+    counts = np.bincount(labels.ravel(), minlength=n + 1)
+    component_areas = np.bincount(labels.ravel(), weights=np.broadcast_to(areas, labels.shape).ravel(),
+                                  minlength=n + 1)
+    counts[0], component_areas[0] = 0, 0
+    return labels, counts, component_areas
+
+def select_components(counts, component_areas, largest=1, min_area=None):
+    # Labels of the largest components, or of every component of at least
+    # min_area square metres, largest first.
+    order = np.argsort(-counts[1:], kind='stable') + 1
+    order = order[counts[order] > 0]
+    if min_area is not None:
+        return order[component_areas[order] >= min_area]
+    return order[:largest]
+
+def polygonize(labels, selected, transform):
+    # Polygon (or multipolygon) of each selected label. Pixels are traced
+    # 4-connected, which keeps rings valid, and the pieces of a label that
+    # only touch at corners are merged afterwards.
+    pieces = {label:[] for label in selected}
+    mask = np.isin(labels, selected)
+    for geometry, label in features.shapes(labels.astype(np.int32), mask=mask,
+                                           transform=transform):
+        pieces[int(label)].append(shape(geometry))
+    return {label:unary_union(parts) for label, parts in pieces.items()}
+
+def hotspots(path, region_geometries, thresholds=(THRESHOLD,), largest=1, min_area=None,
+             band='mean_intensity'):
+    # Rows (region, threshold, count, area, geometry) of the selected
+    # components of mean_intensity <= threshold within each region
+    # geometry (EPSG:4326). The window of each region is read once for
+    # every threshold; regions outside the raster are skipped.
+    rows = []
+    with rio.open(path) as src:
+        crs = src.crs
+        for name, geometry in region_geometries.items():
+            try:
+                window = local_zonal.grid_window(src, [geometry])
+            except WindowError:
+                continue
+            image = local_io.read_band(src, band, window)
+            transform = src.window_transform(window)
+            inside = local_zonal.rasterize_zones([geometry], image.shape, transform, crs) == 0
+            areas = local_zonal.pixel_areas(transform, crs, np.arange(image.shape[0]))[:, None]
+            for threshold in thresholds:
+                with np.errstate(invalid='ignore'):
+                    intense = inside & (image <= threshold)
+                labels, counts, component_areas = components(intense, areas)
+                selected = select_components(counts, component_areas, largest, min_area)
+                polygons = polygonize(labels, selected, transform)
+                for label in selected:
+                    rows.append({'region':name, 'threshold':threshold, 'count':int(counts[label]),
+                                 'area':float(component_areas[label]), 'geometry':polygons[label]})
+    return gpd.GeoDataFrame(rows, columns=['region', 'threshold', 'count', 'area', 'geometry'],
+                            geometry='geometry', crs=crs)
+
+def write_hotspots(path, table):
+    # GeoParquet for .parquet outputs, otherwise any format geopandas can
+    # infer from the extension (e.g. a Shapefile for .shp).
+    if os.path.splitext(path)[1] == '.parquet':
+        table.to_parquet(path)
+    else:
+        table.to_file(path)
+
+
+if __name__ == '__main__':
+
+    ##############################################################
+    # Parse arguments
+    ##############################################################
+
+    parser = argparse.ArgumentParser(
+        description='Options for extracting defoliation hotspots as polygons')
+
+    # Defoliation map with a mean_intensity band, e.g. new_york_2021.
+    parser.add_argument('--defoliation', '-d', action='store', required=True)
+
+    # Regions as GeoJSON, named by their name property. Defaults to the
+    # regions of hotspot_visual.py.
+    parser.add_argument('--regions', '-r', action='store', default=None)
+
+    # Thresholds for intense defoliation.
+    parser.add_argument('--thresholds', '-t', action='store', nargs='+', type=float,
+                        default=[THRESHOLD])
+
+    # Number of largest patches to keep in each region.
+    parser.add_argument('--largest', '-n', action='store', type=int, default=1)
+
+    # Keep every patch of at least this area (m^2) instead of the largest.
+    parser.add_argument('--min_area', '-a', action='store', type=float, default=None)
+
+    # Output file, e.g. hotspots.parquet or hotspots.shp.
+    parser.add_argument('--output', '-o', action='store', default='hotspots.parquet')
+
+    args = parser.parse_args()
+
+    ##############################################################
+    # Extract hotspots
+    ##############################################################
+
+    if args.regions is None:
+        region_geometries = {name:region_geometry(coordinates) for name, coordinates in regions.items()}
+    else:
+        collection = gpd.read_file(args.regions).to_crs('EPSG:4326')
+        region_geometries = {name:geometry.__geo_interface__ for name, geometry
+                             in zip(collection['name'], collection.geometry)}
+
+    table = hotspots(args.defoliation, region_geometries, args.thresholds, args.largest,
+                     args.min_area)
+    write_hotspots(args.output, table)
+    print(f'Wrote {len(table)} hotspots to {args.output}')
@@ -0,0 +1,59 @@
+##########################################################
+# Reading and writing local GeoTIFF/COG scenes for the
+# local (NumPy) pipeline.
+##########################################################
+
+import numpy as np
+import rasterio as rio
+
+
+def band_indexes(src, band_names):
+    # Look up 1-based band indexes by band description, falling back to
+    # the order of the file when bands are not described.
+    if all(src.descriptions):
+        return [src.descriptions.index(name) + 1 for name in band_names]
+    return list(range(1, len(band_names) + 1))
+
+def read_stack(paths, band_names, window=None, dtype=np.float32):
+    # Read every scene into a single preallocated (time, band, y, x) array.
+    with rio.open(paths[0]) as src:
+        if window is None:
+            height, width = src.height, src.width
+        else:
+            height, width = int(window.height), int(window.width)
+
+    stack = np.empty((len(paths), len(band_names), height, width), dtype=dtype)
+    for t, path in enumerate(paths):
+        with rio.open(path) as src:
+            src.read(band_indexes(src, band_names), window=window,
+                     out=stack[t], out_dtype=dtype)
+    return stack
+
+def read_band(src, band, window=None):
+    # One band as float64 with NaN where masked. uint16 bands exported with
+    # min/max properties (e.g. compressed mean_intensity) are decompressed.
+    index = band_indexes(src, [band])[0] if isinstance(band, str) else band
+    image = src.read(index, window=window, masked=True)
+    tags = src.tags()
+    values = image.data.astype(np.float64)
+    if image.dtype == np.uint16 and 'min' in tags and 'max' in tags:
+        minimum, maximum = float(tags['min']), float(tags['max'])
+        values = values * ((maximum - minimum) / 65_535) + minimum
+    values[np.ma.getmaskarray(image)] = np.nan
+    return values
+
+def write_bands(path, bands, profile, properties=None, mask=None):
+    # Write named 2-D bands to a single cloud optimized GeoTIFF. Properties
+    # are stored as tags so image manifests can be built from the file.
+    names = list(bands)
+    first = bands[names[0]]
+    profile = dict(profile, driver='COG', count=len(names), dtype=first.dtype,
+                   height=first.shape[0], width=first.shape[1])
+    with rio.open(path, 'w', **profile) as dst:
+        for i, name in enumerate(names):
+            dst.write(bands[name], i + 1)
+            dst.set_band_description(i + 1, name)
+        if mask is not None:
+            dst.write_mask(mask.astype(np.uint8) * 255)
+        if properties is not None:
+            dst.update_tags(**{key: str(value) for key, value in properties.items()})
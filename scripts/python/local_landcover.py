@@ -0,0 +1,148 @@
+##########################################################
+# Local replacement for landcover_analysis.py. The NLCD
+# landcover, the defoliation scores and the summer
+# observation counts of every year are read once per
+# tile, and the total and intense pixel counts of every
+# forest class, year and threshold come from one joint
+# bincount over (class, year, threshold bin).
+##########################################################
+
+import argparse
+import csv
+
+import numpy as np
+import rasterio as rio
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+
+import local_denoise
+import local_io
+import local_zonal
+
+# NLCD forest classes counted separately.
+landcover_classes = {41:'deciduous', 42:'evergreen', 43:'mixed'}
+
+# Scores of pixels with this many clear summer observations or fewer are
+# set to 0 (not defoliated), as in landcover_analysis.py.
+MIN_OBSERVATIONS = 1
+
+
+def threshold_bins(scores, thresholds):
+    # Number of thresholds below each score, so a pixel is intense for
+    # thresholds[j] (score <= thresholds[j]) exactly when its bin is <= j.
+    return np.searchsorted(thresholds, scores, side='left')
+
+def count_block(landcover, scores, observations, thresholds, counts):
+    # Adds the pixels of a block to counts (class, year, threshold bin).
+    # landcover is (y, x), scores and observations are (year, y, x) with NaN
+    # where masked.
+    n_classes, n_years, n_bins = counts.shape
+    class_index = np.full(landcover.shape, -1, dtype=np.int64)
+    for i, landcover_class in enumerate(landcover_classes):
+        class_index[landcover == landcover_class] = i
+
+    valid = (class_index >= 0) & ~np.isnan(scores)
+    scores = np.where(observations <= MIN_OBSERVATIONS, 0, scores)
+    year_index = np.broadcast_to(np.arange(n_years)[:, None, None], scores.shape)
+    index = ((np.broadcast_to(class_index, scores.shape)[valid] * n_years + year_index[valid])
+             * n_bins + threshold_bins(scores[valid], thresholds))
+    counts += np.bincount(index, minlength=counts.size).reshape(counts.shape)
+    return counts
+
+def landcover_counts(landcover_path, score_paths, observation_paths, thresholds,
+                     region=None, tile_size=4096):
+    # Joint (class, year, threshold bin) pixel counts on the grid of the score
+    # rasters, with the landcover resampled to it by nearest neighbour. Only
+    # pixels within the region geometry (EPSG:4326), if given, are counted.
+    thresholds = np.sort(np.asarray(thresholds, dtype=np.float64))
+    counts = np.zeros((len(landcover_classes), len(score_paths), thresholds.size + 1),
+                      dtype=np.int64)
+    scores_src = [rio.open(path) for path in score_paths]
+    observations_src = [rio.open(path) for path in observation_paths]
+    grid = scores_src[0]
+    with rio.open(landcover_path) as src, \
+         WarpedVRT(src, crs=grid.crs, transform=grid.transform, width=grid.width,
+                   height=grid.height, resampling=Resampling.nearest) as landcover_src:
+        for rows, cols in local_denoise.tiles(grid.shape, tile_size):
+            window = Window.from_slices(rows, cols)
+            landcover = landcover_src.read(1, window=window)
+            if region is not None:
+                inside = local_zonal.rasterize_zones([region], landcover.shape,
+                                                     grid.window_transform(window), grid.crs)
+                landcover = np.where(inside >= 0, landcover, 0)
+            if not np.isin(landcover, list(landcover_classes)).any():
+                continue
+            scores = np.stack([local_io.read_band(src, 1, window) for src in scores_src])
+            observations = np.stack([local_io.read_band(src, 1, window) for src in observations_src])
+            count_block(landcover, scores, observations, thresholds, counts)
+    for src in scores_src + observations_src:
+        src.close()
+    return counts, thresholds
+
+def count_rows(counts, thresholds, years):
+    # Rows of the landcover_counts table for every class, year and threshold.
+    intense = np.cumsum(counts, axis=2)
+    total = counts.sum(axis=2)
+    rows = []
+    for j, threshold in enumerate(thresholds):
+        for i, name in enumerate(landcover_classes.values()):
+            for k, year in enumerate(years):
+                rows.append({'landcover':name, 'total':int(total[i, k]),
+                             'intense':int(intense[i, k, j]), 'year':year,
+                             'threshold':float(threshold)})
+    return rows
+
+
+if __name__ == '__main__':
+
+    ##############################################################
+    # Parse arguments
+    ##############################################################
+
+    parser = argparse.ArgumentParser(
+        description='Options for counting defoliated pixels in each forest type')
+
+    # NLCD 2019 landcover raster.
+    parser.add_argument('--landcover', '-l', action='store', required=True)
+
+    # Defoliation score rasters (defoliation_score_New_York), one per year from --start.
+    parser.add_argument('--scores', '-s', action='store', nargs='+', required=True)
+
+    # Clear summer observation counts, one per year, on the grid of the scores.
+    parser.add_argument('--observations', '-n', action='store', nargs='+', required=True)
+
+    # Year of the first score raster.
+    parser.add_argument('--start', action='store', type=int, default=2019)
+
+    # Thresholds for intense defoliation.
+    parser.add_argument('--thresholds', '-t', action='store', nargs='+', type=float,
+                        default=[-0.045])
+
+    # Region to count over as GeoJSON, e.g. the New York boundary.
+    parser.add_argument('--region', '-r', action='store', default=None)
+
+    # Output table.
+    parser.add_argument('--output', '-o', action='store', default='landcover_counts.csv')
+
+    args = parser.parse_args()
+
+    ##############################################################
+    # Count pixels
+    ##############################################################
+
+    assert len(args.scores) == len(args.observations), \
+        "Expected one observation count raster for each score raster."
+    years = list(range(args.start, args.start + len(args.scores)))
+    region = None
+    if args.region is not None:
+        _, geometries = local_zonal.read_grid(args.region)
+        region = {'type':'GeometryCollection', 'geometries':geometries}
+
+    counts, thresholds = landcover_counts(args.landcover, args.scores, args.observations,
+                                          args.thresholds, region)
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['landcover', 'total', 'intense', 'year', 'threshold'])
+        writer.writeheader()
+        writer.writerows(count_rows(counts, thresholds, years))
+    print(f'Wrote {args.output}')
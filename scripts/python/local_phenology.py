@@ -0,0 +1,150 @@
+##########################################################
+# Local (NumPy) Maximum Separability phenology, as in
+# 0_maximum_separation.py. Cubes are indexed by day on a
+# circular 365 day year, (day, y, x), with windows that
+# wrap around the end of the year.
+##########################################################
+
+import warnings
+
+import numpy as np
+
+N_DAYS = 365
+
+
+##################################################################
+# Circular window sums
+##################################################################
+
+def circular_cumsum(cube, dtype):
+    # Prefix sums along the day axis with a leading zero, so the sum of
+    # days a..b is cumsum[b+1] - cumsum[a].
+    cumsum = np.empty((cube.shape[0] + 1,) + cube.shape[1:], dtype=dtype)
+    cumsum[0] = 0
+    np.cumsum(cube, axis=0, dtype=dtype, out=cumsum[1:])
+    return cumsum
+
+def window_sum(cumsum, start, end, out=None):
+    # Sum over days start..end (inclusive), wrapping around the year.
+    n_days = cumsum.shape[0] - 1
+    start, end = start % n_days, end % n_days
+    if start <= end:
+        return np.subtract(cumsum[end + 1], cumsum[start], out=out)
+    out = np.subtract(cumsum[n_days], cumsum[start], out=out)
+    out += cumsum[end + 1]
+    return out
+
+
+##################################################################
+# Window smoothing
+##################################################################
+
+def daily_bins(EVI, doy, n_days=N_DAYS):
+    # Sum and count of valid observations in a (time, y, x) EVI cube for
+    # each day of the circular year. Masked observations are skipped
+    # rather than propagated as NaN.
+    shape = (n_days,) + EVI.shape[1:]
+    sums = np.zeros(shape, dtype=np.float32)
+    counts = np.zeros(shape, dtype=np.int32)
+    valid = np.empty(EVI.shape[1:], dtype=bool)
+    for t, day in enumerate(np.asarray(doy, dtype=np.int64) % n_days):
+        np.equal(EVI[t], EVI[t], out=valid)
+        np.add(sums[day], EVI[t], out=sums[day], where=valid)
+        counts[day] += valid
+    return sums, counts
+
+def window_smooth(sums, counts, smooth_window=3):
+    # Mean of all observations within smooth_window days of each day,
+    # wrapping around the year. Each day costs two window sums on the
+    # prefix sums, independent of smooth_window. Days without any
+    # observations in their window are NaN. Windows must be shorter than
+    # the year, or the wrap would fold them back onto fewer days.
+    n_days = sums.shape[0]
+    if not 0 <= smooth_window < (n_days - 1) / 2:
+        raise ValueError(f"smooth_window must be between 0 and {(n_days - 2) // 2} days "
+                         f"for a {n_days} day year, got {smooth_window}.")
+    sum_cumsum = circular_cumsum(sums, np.float64)
+    count_cumsum = circular_cumsum(counts, np.int32)
+    smoothed = np.empty(sums.shape, dtype=np.float32)
+    window_counts = np.empty(sums.shape[1:], dtype=np.int32)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for day in range(n_days):
+            window_sum(sum_cumsum, day - smooth_window, day + smooth_window, out=smoothed[day])
+            window_sum(count_cumsum, day - smooth_window, day + smooth_window, out=window_counts)
+            smoothed[day] /= window_counts
+    return smoothed
+
+
+##################################################################
+# Maximum Separability
+##################################################################
+
+def green_threshold(smoothed, threshold=0.5):
+    # Absolute threshold between the 5th and 95th percentile of EVI.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        min_EVI, max_EVI = np.nanpercentile(smoothed, [5, 95], axis=0)
+    return min_EVI + threshold * (max_EVI - min_EVI)
+
+def max_separability(smoothed, change_window=30, threshold=0.5, period=1):
+    # Estimates SoS and EoS from a smoothed (day, y, x) EVI cube, with NaN
+    # on days without observations. The ratio of green days before and
+    # after every candidate day comes from circular prefix sums, so the
+    # cost does not depend on change_window. Pixels without any valid
+    # ratio difference are NaN.
+    n_days = smoothed.shape[0]
+    candidates = np.zeros(n_days, dtype=bool)
+    candidates[::period] = True
+
+    # Only days evaluated as candidates contribute observations.
+    valid = ~np.isnan(smoothed)
+    valid[~candidates] = False
+    thresh = green_threshold(smoothed[candidates], threshold)
+    with np.errstate(invalid='ignore'):
+        green = (smoothed > thresh) & valid
+
+    green_sums = circular_cumsum(green, np.int32)
+    valid_sums = circular_cumsum(valid, np.int32)
+    del green, valid
+
+    shape = smoothed.shape[1:]
+    best_min = np.full(shape, np.inf, dtype=np.float32)
+    best_max = np.full(shape, -np.inf, dtype=np.float32)
+    SoS = np.full(shape, np.nan, dtype=np.float32)
+    EoS = np.full(shape, np.nan, dtype=np.float32)
+
+    green_window = np.empty(shape, dtype=np.int32)
+    valid_window = np.empty(shape, dtype=np.int32)
+    ratio_after = np.empty(shape, dtype=np.float32)
+    ratio_diff = np.empty(shape, dtype=np.float32)
+    update = np.empty(shape, dtype=bool)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for day in np.flatnonzero(candidates):
+            # Ratio of green days before doy
+            window_sum(green_sums, day - change_window, day, out=green_window)
+            window_sum(valid_sums, day - change_window, day, out=valid_window)
+            np.divide(green_window, valid_window, out=ratio_diff)
+
+            # Ratio of green days after doy
+            window_sum(green_sums, day, day + change_window, out=green_window)
+            window_sum(valid_sums, day, day + change_window, out=valid_window)
+            np.divide(green_window, valid_window, out=ratio_after)
+            ratio_diff -= ratio_after
+
+            # Keep the first day with the minimum/maximum difference
+            np.less(ratio_diff, best_min, out=update)
+            np.copyto(best_min, ratio_diff, where=update)
+            SoS[update] = day
+            np.greater(ratio_diff, best_max, out=update)
+            np.copyto(best_max, ratio_diff, where=update)
+            EoS[update] = day
+
+    return {'SoS':SoS, 'EoS':EoS}
+
+def phenology(EVI, doy, smooth_window=3, change_window=30, threshold=0.5, period=1):
+    # Full Maximum Separability pipeline for a masked (time, y, x) EVI cube.
+    sums, counts = daily_bins(EVI, doy)
+    smoothed = window_smooth(sums, counts, smooth_window)
+    del sums, counts
+    return max_separability(smoothed, change_window, threshold, period)
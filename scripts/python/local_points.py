@@ -0,0 +1,150 @@
+##########################################################
+# Local replacement for data_wrangling/get_point_data.py.
+# Time series are extracted for many points at once from
+# a chunked EVI cube (cube_store.py): the points are
+# converted to pixel indexes with one vectorized transform
+# and grouped by spatial chunk, so every chunk is read and
+# decompressed once for all of the points inside it.
+##########################################################
+
+import argparse
+import csv
+
+import numpy as np
+import rasterio as rio
+from rasterio import warp
+from rasterio.transform import rowcol
+from rasterio.windows import Window
+
+import cube_store
+import local_defoliation
+import local_io
+import local_preprocessing
+
+
+def point_indexes(store, longitude, latitude):
+    # Row and column of each point in the cube, and whether it is inside.
+    assert store.crs is not None and store.transform is not None, \
+        f"{store.path} has no georeferencing."
+    xs, ys = warp.transform('EPSG:4326', store.crs, longitude, latitude)
+    rows, cols = rowcol(store.transform, xs, ys)
+    rows, cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+    inside = (rows >= 0) & (rows < store.shape[1]) & (cols >= 0) & (cols < store.shape[2])
+    return rows, cols, inside
+
+def chunk_groups(store, rows, cols, inside):
+    # (chunk row, chunk col) and the indexes of the points in each spatial chunk.
+    points = np.flatnonzero(inside)
+    keys = np.stack([rows[points] // store.chunks[1], cols[points] // store.chunks[2]], axis=1)
+    keys, group = np.unique(keys, axis=0, return_inverse=True)
+    order = np.argsort(group.ravel(), kind='stable')
+    bounds = np.cumsum(np.bincount(group.ravel(), minlength=len(keys)))
+    return [(tuple(key), points[order[start:stop]])
+            for key, start, stop in zip(keys, np.concatenate([[0], bounds[:-1]]), bounds)]
+
+def extract_points(store, rows, cols, groups):
+    # EVI (time, points) for every point, NaN outside the cube or where masked.
+    EVI = np.full((store.shape[0], len(rows)), np.nan, dtype=np.float32)
+    for (chunk_row, chunk_col), points in groups:
+        block_rows = rows[points] - chunk_row * store.chunks[1]
+        block_cols = cols[points] - chunk_col * store.chunks[2]
+        for chunk_time in range(-(-store.shape[0] // store.chunks[0])):
+            block = store.read_chunk((chunk_time, chunk_row, chunk_col))
+            if block is None:
+                continue
+            start = chunk_time * store.chunks[0]
+            EVI[start:start + block.shape[0], points] = block[:, block_rows, block_cols]
+    return EVI
+
+def sample_models(path, rows, cols, groups):
+    # Decompressed slope and offset of the Theil-Sen models at every point,
+    # from a models raster on the grid of the cube, reading one window per
+    # group of points. Integer (compressed) bands need the min/max
+    # properties of 1_1_trends_theilsen.py and are NaN where masked; float
+    # bands are used as is.
+    slope = np.full(len(rows), np.nan, dtype=np.float32)
+    offset = np.full(len(rows), np.nan, dtype=np.float32)
+    with rio.open(path) as src:
+        indexes = local_io.band_indexes(src, ['slope', 'offset'])
+        properties = src.tags()
+        compressed = any(np.issubdtype(np.dtype(src.dtypes[i - 1]), np.integer) for i in indexes)
+        scales = ['min_slope', 'max_slope', 'min_intercept', 'max_intercept']
+        if compressed and not all(scale in properties for scale in scales):
+            raise ValueError(f"{path} has integer slope/offset bands without the "
+                             f"{', '.join(scales)} properties needed to decompress them.")
+        for _, points in groups:
+            row_off, col_off = rows[points].min(), cols[points].min()
+            window = Window(col_off, row_off, cols[points].max() - col_off + 1,
+                            rows[points].max() - row_off + 1)
+            bands = dict(zip(['slope', 'offset'], src.read(indexes, window=window)))
+            if compressed:
+                mask = src.read_masks(indexes[0], window=window) > 0
+                bands['slope'], bands['offset'] = local_defoliation.decompress_models(bands, properties, mask)
+            slope[points] = bands['slope'][rows[points] - row_off, cols[points] - col_off]
+            offset[points] = bands['offset'][rows[points] - row_off, cols[points] - col_off]
+    return slope, offset
+
+def point_table(store, longitude, latitude, models_path=None, start_year=2019, end_year=2022):
+    # Tidy columns (point, date, doy, EVI, EVI_scaled and, with models,
+    # prediction) for every valid observation of every point. EVI_scaled
+    # is divided by the maximum of each year, as in get_point_data.py.
+    rows, cols, inside = point_indexes(store, longitude, latitude)
+    groups = chunk_groups(store, rows, cols, inside)
+    EVI = extract_points(store, rows, cols, groups)
+    EVI_scaled = local_preprocessing.rescale_years(EVI, store.dates, start_year, end_year)
+
+    time, point = np.nonzero(~np.isnan(EVI))
+    order = np.lexsort((time, point))
+    time, point = time[order], point[order]
+    columns = {'point':point, 'date':store.dates[time], 'doy':store.doy[time],
+               'EVI':EVI[time, point], 'EVI_scaled':EVI_scaled[time, point]}
+    if models_path is not None:
+        slope, offset = sample_models(models_path, rows, cols, groups)
+        columns['prediction'] = slope[point] * store.doy[time] + offset[point]
+    return columns
+
+
+if __name__ == '__main__':
+
+    ##############################################################
+    # Parse arguments
+    ##############################################################
+
+    parser = argparse.ArgumentParser(
+        description='Options for extracting point time series from a local EVI cube')
+
+    # Directory of the cube built with cube_store.build.
+    parser.add_argument('--cube', '-c', action='store', required=True)
+
+    # CSV of points with longitude and latitude columns.
+    parser.add_argument('--points', '-p', action='store', required=True)
+
+    # Optional Theil-Sen models raster (slope and offset) on the grid of the cube.
+    parser.add_argument('--models', '-m', action='store', default=None)
+
+    # Years to rescale EVI within.
+    parser.add_argument('--start', action='store', type=int, default=2019)
+    parser.add_argument('--end', action='store', type=int, default=2022)
+
+    # Output table.
+    parser.add_argument('--output', '-o', action='store', default='point_data.csv')
+
+    args = parser.parse_args()
+
+    ##############################################################
+    # Extract time series
+    ##############################################################
+
+    with open(args.points, 'r', newline='') as f:
+        points = list(csv.DictReader(f))
+    longitude = np.array([float(point['longitude']) for point in points])
+    latitude = np.array([float(point['latitude']) for point in points])
+
+    store = cube_store.CubeStore(args.cube)
+    columns = point_table(store, longitude, latitude, args.models, args.start, args.end)
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(list(columns))
+        for values in zip(*columns.values()):
+            writer.writerow(['' if value != value else value for value in values])
+    print(f'Wrote {len(columns["point"])} observations of {len(points)} points to {args.output}')
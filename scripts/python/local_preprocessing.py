@@ -0,0 +1,158 @@
+##########################################################
+# Local (NumPy) counterparts of the preprocess_* functions
+# in preprocessing.py. Each function takes a stack of
+# scenes shaped (time, band, y, x), with bands ordered as
+# in `bands`, and returns the masked EVI cube (time, y, x)
+# as float32 with masked pixels set to NaN, along with the
+# doy of each scene.
+##########################################################
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sources = ['Sentinel2', 'Landsat', 'MODIS', 'HLS']
+
+# Band order expected along the band axis of the stack for each source.
+bands = {'Sentinel2':['B2', 'B4', 'B8', 'cs_cdf'],
+         'Landsat':['BLUE', 'RED', 'NIR', 'QA_PIXEL'],
+         'MODIS':['sur_refl_b03', 'sur_refl_b01', 'sur_refl_b02',
+                  'state_1km', 'num_observations_1km'],
+         'HLS':['BLUE', 'RED', 'NIR', 'Fmask']}
+
+# Multiplier and offset to convert raw values into reflectances.
+scale_factors = {'Sentinel2':(0.0001, 0.0), 'Landsat':(0.0000275, -0.2),
+                 'MODIS':(0.0001, 0.0), 'HLS':(1.0, 0.0)}
+
+# Coefficient of the blue band in the EVI denominator, matching the
+# expressions used in preprocessing.py for each source.
+blue_coefficients = {'Sentinel2':-7.5, 'Landsat':7.5, 'MODIS':7.5, 'HLS':-7.5}
+
+# Sentinel-2 doy starts at 1, all other sources start at 0.
+doy_offsets = {'Sentinel2':1, 'Landsat':0, 'MODIS':0, 'HLS':0}
+
+# QA parameters
+CLEAR_THRESHOLD = 0.65 # Cloud Score+ cs_cdf threshold for Sentinel-2
+LANDSAT_QA_BITS = (1 << 4) | (1 << 3) # Cloud shadow and cloud
+MODIS_QA_BITS = (1 << 15) | (1 << 2) | (1 << 10) | (1 << 8) | (1 << 9) # Snow, shadow, cloud, cirrus
+HLS_QA_BITS = 0b00101110 # Cloud, adjacent cloud, cloud shadow, snow/ice
+
+
+##################################################################
+# Helper functions
+##################################################################
+
+def day_of_year(dates, offset=0):
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    doy = (dates - dates.astype('datetime64[Y]')).astype(np.int64) + offset
+    return doy.astype(np.uint16)
+
+def qa_clear(source, stack, out):
+    # Writes True into `out` wherever the QA band(s) mark a clear observation.
+    if source == 'Sentinel2':
+        np.greater_equal(stack[:, 3], CLEAR_THRESHOLD, out=out)
+    elif source == 'Landsat':
+        qa = stack[:, 3].astype(np.uint16)
+        np.equal(np.bitwise_and(qa, LANDSAT_QA_BITS, out=qa), 0, out=out)
+    elif source == 'MODIS':
+        qa = stack[:, 3].astype(np.uint16)
+        np.equal(np.bitwise_and(qa, MODIS_QA_BITS, out=qa), 0, out=out)
+        np.logical_and(out, stack[:, 4] > 0, out=out)
+    elif source == 'HLS':
+        qa = stack[:, 3].astype(np.uint8)
+        np.equal(np.bitwise_and(qa, HLS_QA_BITS, out=qa), 0, out=out)
+    return out
+
+def preprocess_block(stack, doy, source, phenology, out):
+    # Computes masked EVI for a block of rows. Scratch buffers are sized
+    # to the block and reused for every scene in it.
+    multiplier, offset = scale_factors[source]
+    shape = out.shape
+
+    blue = np.empty(shape, dtype=np.float32)
+    red = np.empty(shape, dtype=np.float32)
+    nir = np.empty(shape, dtype=np.float32)
+    for band, buffer in zip(range(3), [blue, red, nir]):
+        np.multiply(stack[:, band], multiplier, out=buffer, casting='unsafe')
+        buffer += offset
+
+    # EVI = 2.5 * (NIR - RED) / (NIR + 6*RED + c*BLUE + 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.subtract(nir, red, out=out)
+        red *= 6
+        red += nir
+        blue *= blue_coefficients[source]
+        red += blue
+        red += 1
+        out /= red
+        out *= 2.5
+
+    # Masks
+    valid = qa_clear(source, stack, np.empty(shape, dtype=bool))
+    scratch = np.empty(shape, dtype=bool)
+    with np.errstate(invalid='ignore'):
+        valid &= np.greater_equal(out, 0, out=scratch)
+        valid &= np.less_equal(out, 1, out=scratch)
+    if phenology is not None:
+        doy_band = doy[:, None, None]
+        valid &= np.greater_equal(doy_band, phenology['SoS'], out=scratch)
+        valid &= np.less_equal(doy_band, phenology['EoS'], out=scratch)
+    np.logical_not(valid, out=valid)
+    out[valid] = np.nan
+    return out
+
+def preprocess(stack, dates, source, phenology=None, workers=1, block_rows=256):
+    n_time, n_bands, height, width = stack.shape
+    assert n_bands == len(bands[source]), f"Expected bands {bands[source]} for {source}."
+    assert n_time == len(dates), "Number of dates must match number of scenes."
+
+    doy = day_of_year(dates, doy_offsets[source])
+    EVI = np.empty((n_time, height, width), dtype=np.float32)
+
+    def run(row):
+        rows = slice(row, min(row + block_rows, height))
+        pheno = None
+        if phenology is not None:
+            pheno = {key: phenology[key][rows] for key in ['SoS', 'EoS']}
+        preprocess_block(stack[:, :, rows], doy, source, pheno, EVI[:, rows])
+
+    # NumPy releases the GIL inside its kernels, so row blocks
+    # can be processed in parallel with threads.
+    row_starts = range(0, height, block_rows)
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(run, row_starts))
+    else:
+        for row in row_starts:
+            run(row)
+    return EVI, doy
+
+
+##################################################################
+# Per-source entry points, mirroring preprocessing.py
+##################################################################
+
+def preprocess_Landsat(stack, dates, phenology=None, workers=1):
+    return preprocess(stack, dates, 'Landsat', phenology, workers)
+
+def preprocess_MODIS(stack, dates, phenology=None, workers=1):
+    return preprocess(stack, dates, 'MODIS', phenology, workers)
+
+def preprocess_Sentinel2(stack, dates, phenology=None, workers=1):
+    return preprocess(stack, dates, 'Sentinel2', phenology, workers)
+
+def preprocess_HLS(stack, dates, phenology=None, workers=1):
+    return preprocess(stack, dates, 'HLS', phenology, workers)
+
+def rescale_years(EVI, dates, start_year, end_year):
+    # Divide each year of observations by the per-pixel maximum of that year.
+    years = np.asarray(dates, dtype='datetime64[Y]').astype(np.int64) + 1970
+    EVI_scaled = np.empty_like(EVI)
+    for year in range(start_year, end_year + 1):
+        in_year = years == year
+        if not in_year.any():
+            continue
+        year_max = np.fmax.reduce(EVI[in_year], axis=0)
+        EVI_scaled[in_year] = EVI[in_year] / year_max
+    EVI_scaled[(years < start_year) | (years > end_year)] = np.nan
+    return EVI_scaled
@@ -0,0 +1,147 @@
+##########################################################
+# Local replacement for calculate_ROC.js. mean_intensity
+# is sampled once at every validation point, the scores
+# are sorted, and the classification counts for every
+# threshold are read from cumulative counts of positives
+# and negatives, so a finer threshold grid costs nothing
+# beyond a binary search.
+##########################################################
+
+import argparse
+import csv
+import os
+
+import numpy as np
+import rasterio as rio
+from rasterio import warp
+from rasterio.transform import rowcol
+from rasterio.windows import Window
+
+import local_io
+
+columns = ['threshold', 'TPR', 'FPR', 'OA', 'Pos_UA', 'Neg_UA', 'valid_classified']
+
+
+def thresholds(start=0.3, end=-0.40, step=-0.005):
+    # As ee.List.sequence(start, end, step).
+    n = int(np.floor((end - start) / step + 1e-9)) + 1
+    return start + step * np.arange(n)
+
+def read_validation(path):
+    # Longitude, latitude and combined label of every validation point in
+    # a CSV, keeping points with combined >= 0 as calculate_ROC.js does.
+    with open(path, 'r', newline='') as f:
+        rows = [row for row in csv.DictReader(f) if row['combined'] != '']
+    longitude = np.array([float(row['longitude']) for row in rows])
+    latitude = np.array([float(row['latitude']) for row in rows])
+    combined = np.array([float(row['combined']) for row in rows])
+    keep = combined >= 0
+    return longitude[keep], latitude[keep], combined[keep]
+
+def sample_points(path, longitude, latitude, band='mean_intensity'):
+    # Value of a band at each point (NaN where masked or outside the image),
+    # reading only the window covering the points.
+    with rio.open(path) as src:
+        xs, ys = warp.transform('EPSG:4326', src.crs, longitude, latitude)
+        rows, cols = rowcol(src.transform, xs, ys)
+        rows, cols = np.asarray(rows), np.asarray(cols)
+        inside = (rows >= 0) & (rows < src.height) & (cols >= 0) & (cols < src.width)
+        values = np.full(len(rows), np.nan)
+        if not inside.any():
+            return values
+
+        row_off, col_off = rows[inside].min(), cols[inside].min()
+        window = Window(col_off, row_off, cols[inside].max() - col_off + 1,
+                        rows[inside].max() - row_off + 1)
+        image = local_io.read_band(src, band, window)
+        values[inside] = image[rows[inside] - row_off, cols[inside] - col_off]
+    return values
+
+def roc_curves(scores, labels, threshold_values):
+    # Rates for every threshold (pixel classified as defoliated when
+    # score <= threshold) of each row of scores (images, points), with NaN
+    # for points without a score. Sites with different points can share a
+    # call by padding their rows with NaN. Returns a dict of
+    # (images, thresholds) arrays named as the calculate_ROC.js columns;
+    # rates of empty groups are NaN, as aggregate_mean gives null.
+    scores = np.atleast_2d(np.asarray(scores, dtype=np.float64))
+    labels = np.broadcast_to(np.asarray(labels, dtype=np.float64), scores.shape)
+    threshold_values = np.asarray(threshold_values, dtype=np.float64)
+    shape = (scores.shape[0], threshold_values.size)
+    classified_pos, true_pos, false_pos = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+    n_valid, n_pos, n_neg = np.zeros(shape[0]), np.zeros(shape[0]), np.zeros(shape[0])
+
+    for i in range(shape[0]):
+        valid = ~np.isnan(scores[i]) & ~np.isnan(labels[i])
+        order = np.argsort(scores[i][valid], kind='stable')
+        sorted_scores = scores[i][valid][order]
+        sorted_labels = labels[i][valid][order]
+        # Number of positives/negatives among the k lowest scores.
+        cum_pos = np.concatenate([[0], np.cumsum(sorted_labels == 1)])
+        cum_neg = np.concatenate([[0], np.cumsum(sorted_labels == 0)])
+        k = np.searchsorted(sorted_scores, threshold_values, side='right')
+        classified_pos[i], true_pos[i], false_pos[i] = k, cum_pos[k], cum_neg[k]
+        n_valid[i], n_pos[i], n_neg[i] = valid.sum(), cum_pos[-1], cum_neg[-1]
+
+    true_neg = n_neg[:, None] - false_pos
+    classified_neg = n_valid[:, None] - classified_pos
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {'threshold':np.broadcast_to(threshold_values, shape),
+                'TPR':true_pos / n_pos[:, None],
+                'FPR':false_pos / n_neg[:, None],
+                'OA':(true_pos + true_neg) / n_valid[:, None],
+                'Pos_UA':true_pos / classified_pos,
+                'Neg_UA':true_neg / classified_neg,
+                'valid_classified':np.broadcast_to(n_valid[:, None], shape)}
+
+def write_roc(path, rates, row=0):
+    # One ROC_{output}.csv table, with the columns of calculate_ROC.js.
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for values in zip(*[rates[name][row] for name in columns]):
+            writer.writerow(['' if value != value else value for value in values[:-1]]
+                            + [int(values[-1])])
+
+
+if __name__ == '__main__':
+
+    ##############################################################
+    # Parse arguments
+    ##############################################################
+
+    parser = argparse.ArgumentParser(
+        description='Options for calculating ROC curves against validation points')
+
+    # CSV of validation points with longitude, latitude and combined columns.
+    parser.add_argument('--validation', '-v', action='store', required=True)
+
+    # Defoliation images with a mean_intensity band, e.g. every method for a site.
+    parser.add_argument('--images', '-i', action='store', nargs='+', required=True)
+
+    # Prefix of the outputs, e.g. Mt_Pleasant, giving ROC_Mt_Pleasant_{image}.csv.
+    parser.add_argument('--site', '-s', action='store', required=True)
+
+    # Threshold grid: start, end and step.
+    parser.add_argument('--thresholds', '-t', action='store', nargs=3, type=float,
+                        default=[0.3, -0.40, -0.005])
+
+    # Folder to write the ROC tables to.
+    parser.add_argument('--output', '-o', action='store', default='.')
+
+    args = parser.parse_args()
+
+    ##############################################################
+    # Calculate ROC curves
+    ##############################################################
+
+    longitude, latitude, combined = read_validation(args.validation)
+    scores = np.stack([sample_points(path, longitude, latitude) for path in args.images])
+    rates = roc_curves(scores, combined, thresholds(*args.thresholds))
+
+    os.makedirs(args.output, exist_ok=True)
+    for i, path in enumerate(args.images):
+        name = os.path.splitext(os.path.basename(path))[0]
+        output = os.path.join(args.output, f'ROC_{args.site}_{name}.csv')
+        write_roc(output, rates, i)
+        print(f'Wrote {output}')
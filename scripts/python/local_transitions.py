@@ -0,0 +1,156 @@
+##########################################################
+# Local replacement for transition_matrix.py. The state of
+# every pixel in each year (clear, defoliated or masked)
+# is packed into one base-3 trajectory code, and the codes
+# of each tile are counted with a single bincount. The
+# counts form the full (3,) * n_years transition tensor,
+# from which the yearly clear/defol transitions and longer
+# outbreak trajectories are all read after one pass over
+# the score rasters.
+##########################################################
+
+import argparse
+import csv
+
+import numpy as np
+import rasterio as rio
+from rasterio.windows import Window
+
+import local_denoise
+import local_zonal
+import qa_codec
+
+# Pixel states, in the order of the tensor axes.
+states = ['clear', 'defol', 'masked']
+CLEAR, DEFOL, MASKED = 0, 1, 2
+
+# QA flags a pixel needs in a year for its score to be used.
+mask_flags = ['forest', 'preseason', 'weak_obs']
+
+
+def pixel_states(scores, qa, years):
+    # State (year, y, x) of every pixel from the denoised scores (year, y, x),
+    # NaN where masked, and the QA mask (y, x).
+    state = np.full(scores.shape, MASKED, dtype=np.uint8)
+    for i, year in enumerate(years):
+        valid = qa_codec.is_valid(qa, qa_codec.mask_value(year, mask_flags)) & ~np.isnan(scores[i])
+        state[i][valid] = np.where(scores[i][valid] != 0, DEFOL, CLEAR)
+    return state
+
+def trajectory_codes(state):
+    # Base-3 code of each pixel's states, with the first year as the most
+    # significant digit so the counts reshape to [first year, ..., last year].
+    codes = np.zeros(state.shape[1:], dtype=np.int64)
+    for year_state in state:
+        codes *= len(states)
+        codes += year_state
+    return codes
+
+def count_trajectories(qa_path, score_paths, years, region=None, tile_size=4096):
+    # Number of pixels following every trajectory of states over the years,
+    # as a (3,) * n_years tensor. score_paths are the denoised scores of each
+    # year, on the grid of the QA mask raster. Only pixels within the region
+    # geometry (EPSG:4326), if given, are counted.
+    n_codes = len(states) ** len(years)
+    counts = np.zeros(n_codes, dtype=np.int64)
+    sources = [rio.open(path) for path in score_paths]
+    with rio.open(qa_path) as qa_src:
+        for src, path in zip(sources, score_paths):
+            assert src.shape == qa_src.shape and src.transform == qa_src.transform, \
+                f"{path} is not aligned with {qa_path}."
+
+        for rows, cols in local_denoise.tiles(qa_src.shape, tile_size):
+            window = Window.from_slices(rows, cols)
+            qa = qa_src.read(1, window=window)
+            scores = np.stack([src.read(1, window=window, masked=True).astype(np.float32).filled(np.nan)
+                               for src in sources])
+            codes = trajectory_codes(pixel_states(scores, qa, years))
+            if region is not None:
+                inside = local_zonal.rasterize_zones([region], qa.shape,
+                                                     qa_src.window_transform(window), qa_src.crs)
+                codes = codes[inside >= 0]
+            counts += np.bincount(codes.ravel(), minlength=n_codes)
+    for src in sources:
+        src.close()
+    return counts.reshape((len(states),) * len(years))
+
+def pair_counts(tensor, first, second):
+    # (3, 3) counts of states in year index first against year index second.
+    other = tuple(axis for axis in range(tensor.ndim) if axis not in (first, second))
+    return tensor.sum(axis=other)
+
+def yearly_transitions(tensor, years):
+    # Rows of the transition_data table: pixel counts from each clear/defol
+    # state to the next in every pair of consecutive years.
+    rows = []
+    for i, year in enumerate(years[:-1]):
+        pairs = pair_counts(tensor, i, i + 1)
+        for from_state in [CLEAR, DEFOL]:
+            for to_state in [CLEAR, DEFOL]:
+                rows.append({'from':states[from_state], 'to':states[to_state], 'year':year,
+                             'sum':int(pairs[from_state, to_state])})
+    return rows
+
+def trajectories(tensor, years):
+    # Rows of pixel counts for every trajectory over all years with at least
+    # one pixel, e.g. clear-defol-defol-clear-masked.
+    rows = []
+    for index in zip(*np.nonzero(tensor)):
+        row = {str(year):states[state] for year, state in zip(years, index)}
+        row['sum'] = int(tensor[index])
+        rows.append(row)
+    return rows
+
+def write_rows(path, rows, selectors):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=selectors)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == '__main__':
+
+    ##############################################################
+    # Parse arguments
+    ##############################################################
+
+    parser = argparse.ArgumentParser(
+        description='Options for counting defoliation transitions between years')
+
+    # Bit-packed QA mask raster (qa_masks_New_York).
+    parser.add_argument('--qa', '-q', action='store', required=True)
+
+    # Denoised score rasters (score_denoised_New_York), one per year from --start.
+    parser.add_argument('--scores', '-s', action='store', nargs='+', required=True)
+
+    # Year of the first score raster.
+    parser.add_argument('--start', action='store', type=int, default=2019)
+
+    # Region to count over as GeoJSON, e.g. the New York boundary.
+    parser.add_argument('--region', '-r', action='store', default=None)
+
+    # Output table of yearly transitions.
+    parser.add_argument('--output', '-o', action='store', default='transition_data.csv')
+
+    # Optional output table of the counts of every multi-year trajectory.
+    parser.add_argument('--trajectories', '-t', action='store', default=None)
+
+    args = parser.parse_args()
+
+    ##############################################################
+    # Count transitions
+    ##############################################################
+
+    years = list(range(args.start, args.start + len(args.scores)))
+    region = None
+    if args.region is not None:
+        _, geometries = local_zonal.read_grid(args.region)
+        region = {'type':'GeometryCollection', 'geometries':geometries}
+
+    tensor = count_trajectories(args.qa, args.scores, years, region)
+    write_rows(args.output, yearly_transitions(tensor, years), ['from', 'to', 'year', 'sum'])
+    print(f'Wrote {args.output}')
+    if args.trajectories is not None:
+        write_rows(args.trajectories, trajectories(tensor, years),
+                   [str(year) for year in years] + ['sum'])
+        print(f'Wrote {args.trajectories}')
@@ -0,0 +1,350 @@
+##########################################################
+# Local (NumPy) trend fitting for the masked EVI cubes
+# produced by local_preprocessing.py.
+##########################################################
+
+import numpy as np
+
+import local_io
+
+
+##################################################################
+# Model compression, matching 1_1_trends_theilsen.py and
+# 2_1_defoliation_theilsen.py
+##################################################################
+
+def compress(values, minimum, maximum):
+    # Reformat to fit in uint16 with reasonable data fidelity
+    scaled = (values - minimum) / (maximum - minimum) * 65_535
+    scaled = np.clip(np.nan_to_num(scaled, nan=0), 0, 65_535)
+    return scaled.astype(np.uint16)
+
+def decompress(values, minimum, maximum):
+    return values.astype(np.float32) * np.float32((maximum - minimum) / 65_535) + np.float32(minimum)
+
+
+##################################################################
+# Theil-Sen model fitting
+##################################################################
+
+def sort_observations(x, y):
+    # Moves the valid observations of each row of y (P, T) to the front,
+    # ordered by x and then by y, and drops the columns past the largest
+    # valid count. Returns the reordered x and y (P, width), with missing
+    # observations at x = 0 and y = inf so they stay last whatever the slope.
+    valid = ~np.isnan(y)
+    n_valid = valid.sum(axis=1)
+    width = max(1, n_valid.max(initial=0))
+    by_y = np.argsort(y, axis=1, kind='stable')
+    x_rank = np.unique(x, return_inverse=True)[1]
+    key = np.where(np.take_along_axis(valid, by_y, axis=1), x_rank[by_y], x_rank.size)
+    order = np.take_along_axis(by_y, np.argsort(key, axis=1, kind='stable')[:, :width], axis=1)
+    kept = np.arange(width) < n_valid[:, None]
+    return (np.where(kept, x[order], 0),
+            np.where(kept, np.take_along_axis(y, order, axis=1), np.inf))
+
+def count_inversions(order):
+    # Number of inversions in each row of order (P, n), a permutation of
+    # range(n), by bottom-up merge sort in O(n log n). At each level one
+    # sort of the rows merges the sorted halves of every block (the keys
+    # carry the block and the half of each value), and each value from a
+    # right half counts the left-half values above it, which follow from
+    # its position in the merged block.
+    n_rows, n = order.shape
+    counts = np.zeros(n_rows)
+    values = order.astype(np.int32)
+    positions = np.arange(n)
+    value_bits = max(1, (n - 1).bit_length())
+    level = 0
+    while (1 << level) < n:
+        span = 2 << level
+        offset = positions & (span - 1)
+        left = offset < span // 2
+        block = positions >> (level + 1)
+        keys = (values << 1) + ((block << (value_bits + 1)) + left).astype(np.int32)
+        keys.sort(axis=1)
+
+        # A block with a left and b right values has a * b + b * (b - 1) / 2
+        # inversions across its halves, less the offsets of its right values
+        # in the merged block.
+        n_left = np.bincount(block, weights=left)
+        n_right = np.bincount(block, weights=~left)
+        counts += (n_left * n_right + n_right * (n_right - 1) / 2).sum() - offset.sum()
+        counts += (keys & 1).astype(np.float64) @ offset.astype(np.float64)
+        values = (keys >> 1) & ((1 << value_bits) - 1)
+        level += 1
+    return counts.astype(np.int64)
+
+def count_below(xs, ys, slope):
+    # Number of pairwise slopes below slope in each row of the observations
+    # from sort_observations. A pair i < j with x_i < x_j has a slope below
+    # slope exactly when y - slope * x is lower at j than at i, so these are
+    # the inversions of the rows' order by y - slope * x. Pairs with equal x
+    # (already in ascending y) and ties keep their order and are not counted.
+    order = np.argsort(ys - slope[:, None] * xs, axis=1, kind='stable')
+    return count_inversions(order)
+
+def valid_pairs(valid, x):
+    # Number of pairs of valid observations with distinct x in each row.
+    order = np.argsort(x, kind='stable')
+    starts = np.flatnonzero(np.diff(x[order], prepend=-np.inf))
+    per_x = np.add.reduceat(valid[:, order].astype(np.int64), starts, axis=1)
+    n_valid = valid.sum(axis=1)
+    return (n_valid * (n_valid - 1) - (per_x * (per_x - 1)).sum(axis=1)) // 2
+
+def bracket_medians(xs, ys, n_pairs, rng, rounds=4, samples=4, margin=2):
+    # Randomized selection of bounds low and high around the middle slopes
+    # of each row. Each round draws samples * width random pairs, keeps the
+    # slopes between the bounds, and tries as new bounds the sample
+    # quantiles margin standard errors either side of where the middle ranks
+    # fall, counting the slopes below each with count_below. Rounds stop
+    # once the bounds hold no more slopes than there are observations.
+    # Returns the bounds and the number of slopes below each, -inf/inf and
+    # 0/n_pairs where a bound was never found.
+    n_rows, width = xs.shape
+    lower_rank, upper_rank = (n_pairs - 1) // 2, n_pairs // 2
+    low, high = np.full(n_rows, -np.inf), np.full(n_rows, np.inf)
+    n_low, n_high = np.zeros(n_rows, dtype=np.int64), n_pairs.copy()
+    for _ in range(rounds):
+        active = np.flatnonzero(n_high - n_low > width)
+        if active.size == 0:
+            break
+        xa, ya = xs[active], ys[active]
+        i, j = rng.integers(0, width, size=(2, samples * width))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sample = (ya[:, j] - ya[:, i]) / (xa[:, j] - xa[:, i])
+        inside = np.isfinite(sample) & (sample >= low[active, None]) & (sample < high[active, None])
+        sample[~inside] = np.inf
+        sample.sort(axis=1)
+
+        n_sample = inside.sum(axis=1)
+        spread = margin * np.sqrt(n_sample)
+        share = n_sample / (n_high - n_low)[active]
+        rows = np.arange(active.size)
+        for index in (np.floor((lower_rank - n_low)[active] * share - spread),
+                      np.ceil((upper_rank + 1 - n_low)[active] * share + spread)):
+            index = index.astype(np.int64)
+            usable = (index >= 1) & (index < n_sample)
+            index = np.clip(index, 1, sample.shape[1] - 1)
+            bound = np.where(usable, (sample[rows, index - 1] + sample[rows, index]) / 2, 0)
+            below = count_below(xa, ya, bound)
+            raised = usable & (below <= lower_rank[active])
+            low[active[raised]], n_low[active[raised]] = bound[raised], below[raised]
+            lowered = usable & (below > upper_rank[active])
+            high[active[lowered]], n_high[active[lowered]] = bound[lowered], below[lowered]
+    return low, high, n_low, n_high
+
+def bracketed_slopes(xs, ys, low, high):
+    # The pairwise slopes between low and high in each row, sorted and
+    # padded with inf, and their number: the pairs counted by count_below at
+    # high but not at low, found with the same orders so the two always
+    # agree. Such a pair is in order by y - low * x and out of order by
+    # y - high * x, so its observations are fewer positions apart in the
+    # first order than the largest change in position between the two, and
+    # only pairs that close are compared. Rows run from the widest window
+    # down, so each lag covers a leading block of rows.
+    n_rows, width = xs.shape
+    by_low = np.argsort(ys - low[:, None] * xs, axis=1, kind='stable')
+    by_high = np.argsort(ys - high[:, None] * xs, axis=1, kind='stable')
+    position = np.empty_like(by_high)
+    np.put_along_axis(position, by_high, np.arange(width), axis=1)
+    position = np.take_along_axis(position, by_low, axis=1)
+    moved = position - np.arange(width)
+    window = moved.max(axis=1) - moved.min(axis=1)
+
+    widest = np.argsort(-window, kind='stable')
+    window = window[widest]
+    xs = np.take_along_axis(xs, by_low, axis=1)[widest]
+    ys = np.take_along_axis(ys, by_low, axis=1)[widest]
+    by_low, position = by_low[widest], position[widest]
+    values, owners = [np.zeros(0)], [np.zeros(0, dtype=np.int64)]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for lag in range(1, window.max(initial=0)):
+            n = np.count_nonzero(window > lag)
+            inside = ((by_low[:n, lag:] > by_low[:n, :-lag])
+                      & (position[:n, lag:] < position[:n, :-lag]))
+            slopes = (ys[:n, lag:] - ys[:n, :-lag]) / (xs[:n, lag:] - xs[:n, :-lag])
+            values.append(slopes[inside])
+            owners.append(np.nonzero(inside)[0])
+    values, owners = np.concatenate(values), np.concatenate(owners)
+
+    order = np.argsort(owners, kind='stable')
+    counts = np.bincount(owners, minlength=n_rows)
+    starts = np.cumsum(counts) - counts
+    padded = np.full((n_rows, max(1, counts.max(initial=0))), np.inf)
+    padded[owners[order], np.arange(values.size) - starts[owners[order]]] = values[order]
+    padded.sort(axis=1)
+    slopes = np.empty_like(padded)
+    slopes[widest] = padded
+    n_inside = np.empty_like(counts)
+    n_inside[widest] = counts
+    return slopes, n_inside
+
+def row_medians(values):
+    # Median of the non-NaN values in each row of a (P, N) array, with one
+    # in-place np.partition for all rows. Missing values are replaced by
+    # -inf and +inf in the numbers that put the lower middle value of every
+    # row at column (N - 1) // 2, so the same kth works whatever the valid
+    # count. Rows without valid values are NaN.
+    n_rows, n = values.shape
+    if n == 0:
+        return np.full(n_rows, np.nan)
+    missing = np.isnan(values)
+    n_valid = n - missing.sum(axis=1)
+    k = (n - 1) // 2
+    n_low = k - (np.maximum(n_valid, 1) - 1) // 2
+    values[missing] = np.inf
+    missing &= np.cumsum(missing, axis=1, dtype=np.int32) <= n_low[:, None]
+    values[missing] = -np.inf
+    values.partition([k, min(k + 1, n - 1)], axis=1)
+
+    median = values[:, k].astype(np.float64)
+    even = (n_valid % 2 == 0) & (n_valid > 0)
+    median[even] = (median[even] + values[even, min(k + 1, n - 1)]) / 2
+    median[n_valid == 0] = np.nan
+    return median
+
+def all_slopes(xs, ys):
+    # Every pairwise slope (P, pairs) of the observations from
+    # sort_observations, NaN for pairs with a missing value or equal x.
+    i, j = np.triu_indices(xs.shape[1], 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slopes = (ys[:, j] - ys[:, i]) / (xs[:, j] - xs[:, i])
+    slopes[~np.isfinite(slopes)] = np.nan
+    return slopes
+
+def median_slopes(xs, ys, n_pairs, seed=0):
+    # Median pairwise slope of each row of the observations from
+    # sort_observations, given the number of valid pairs: bracket_medians
+    # narrows an interval around the middle slopes and bracketed_slopes
+    # lists the slopes inside it, O(T log T) per row in expectation. Rows
+    # where the listed slopes do not match the counts (or that were never
+    # bracketed) fall back to all their pairwise slopes.
+    rng = np.random.default_rng(seed)
+    lower_rank, upper_rank = (n_pairs - 1) // 2, n_pairs // 2
+    low, high, n_low, n_high = bracket_medians(xs, ys, n_pairs, rng)
+
+    median = np.full(xs.shape[0], np.nan)
+    bracketed = np.flatnonzero(np.isfinite(low) & np.isfinite(high))
+    slopes, n_inside = bracketed_slopes(xs[bracketed], ys[bracketed],
+                                        low[bracketed], high[bracketed])
+    found = n_inside == (n_high - n_low)[bracketed]
+    rows, selected = np.flatnonzero(found), bracketed[found]
+    median[selected] = (slopes[rows, (lower_rank - n_low)[selected]]
+                        + slopes[rows, (upper_rank - n_low)[selected]]) / 2
+
+    rest = np.isnan(median) & (n_pairs > 0)
+    if rest.any():
+        median[rest] = row_medians(all_slopes(xs[rest], ys[rest]))
+    return median
+
+def theil_sen_pixels(x, y, max_values=2**20):
+    # Theil-Sen slope and offset for each row of y (P, T) against the shared
+    # x (T,), where missing observations in y are NaN. The slope is the
+    # median of the pairwise slopes and the offset the median of the
+    # residual intercepts. Rows are processed in groups of about max_values
+    # observations to keep memory bounded.
+    n_pixels, n_time = y.shape
+    x = np.asarray(x, dtype=np.float64)
+    n_pairs = valid_pairs(~np.isnan(y), x)
+    step = max(1, max_values // max(1, n_time))
+
+    slope = np.full(n_pixels, np.nan)
+    for start in range(0, n_pixels if n_time else 0, step):
+        rows = slice(start, min(start + step, n_pixels))
+        xs, ys = sort_observations(x, y[rows].astype(np.float64))
+        slope[rows] = median_slopes(xs, ys, n_pairs[rows])
+    offset = row_medians(y - slope[:, None] * x)
+    return slope, offset
+
+def theil_sen(EVI, doy, chunk_pixels=65_536):
+    # Fits a Theil-Sen model of EVI against doy for every pixel of a
+    # (time, y, x) cube, processing chunk_pixels pixels at a time to keep
+    # memory bounded.
+    n_time, height, width = EVI.shape
+    flat = EVI.reshape(n_time, height * width)
+    x = np.asarray(doy, dtype=np.float64)
+
+    slope = np.empty(height * width, dtype=np.float32)
+    offset = np.empty(height * width, dtype=np.float32)
+    for start in range(0, height * width, chunk_pixels):
+        pixels = slice(start, min(start + chunk_pixels, height * width))
+        y = np.ascontiguousarray(flat[:, pixels].T)
+        slope[pixels], offset[pixels] = theil_sen_pixels(x, y)
+    return slope.reshape(height, width), offset.reshape(height, width)
+
+def compress_theil_sen(slope, offset, min_slope=-0.006, max_slope=0.004,
+                       min_intercept=0.3, max_intercept=1.3):
+    # Returns the uint16 slope/offset bands and the properties needed to
+    # decompress them, as exported by 1_1_trends_theilsen.py, with the mask
+    # of pixels that have a model. compress stores NaN as 0, which would
+    # decompress to the minimum, so the mask has to be written with them.
+    bands = {'slope':compress(slope, min_slope, max_slope),
+             'offset':compress(offset, min_intercept, max_intercept)}
+    properties = {'method':'Theil-Sen',
+                  'min_slope':min_slope, 'max_slope':max_slope,
+                  'min_intercept':min_intercept, 'max_intercept':max_intercept}
+    mask = ~(np.isnan(slope) | np.isnan(offset))
+    return bands, properties, mask
+
+def write_theil_sen(path, slope, offset, profile):
+    # Writes the compressed models to a COG, masked where there is no model.
+    bands, properties, mask = compress_theil_sen(slope, offset)
+    local_io.write_bands(path, bands, profile, properties, mask=mask)
+
+
+##################################################################
+# Harmonic model fitting, as in 1_2_trends_harmonic.py
+##################################################################
+
+harmonic_bands = ['constant', 'doy', 'sin_12', 'cos_12', 'sin_4', 'cos_4']
+
+def harmonic_features(dates, start_date):
+    # Model features for each scene: constant, days since start_date and
+    # sin/cos terms at annual and 3x annual frequency.
+    dates = np.asarray(dates, dtype='datetime64[s]')
+    days = (dates - np.datetime64(start_date, 's')).astype(np.float64) / 86_400
+    omega = 2 * 3.14159265359 / 365.25
+    return np.stack([np.ones_like(days), days,
+                     np.sin(days * omega), np.cos(days * omega),
+                     np.sin(days * 3 * omega), np.cos(days * 3 * omega)], axis=1)
+
+def accumulate_normal_equations(EVI, features, XtX=None, Xty=None):
+    # Adds a batch of scenes, EVI (time, y, x) with NaN for masked pixels
+    # and features (time, 6), to the per-pixel normal equations. Can be
+    # called one scene (or a few) at a time so the full stack never needs
+    # to be in memory.
+    n_time = EVI.shape[0]
+    n_features = features.shape[1]
+    flat = EVI.reshape(n_time, -1)
+    if XtX is None:
+        XtX = np.zeros((flat.shape[1], n_features, n_features))
+        Xty = np.zeros((flat.shape[1], n_features))
+
+    valid = ~np.isnan(flat)
+    outer = np.einsum('ti,tj->tij', features, features)
+    XtX += np.einsum('tp,tij->pij', valid, outer, optimize=True)
+    Xty += np.einsum('tp,ti->pi', np.where(valid, flat, 0), features, optimize=True)
+    return XtX, Xty
+
+def solve_normal_equations(XtX, Xty):
+    # Batched solve of the per-pixel normal equations. Pixels with too few
+    # observations, or singular systems, are NaN.
+    n_pixels, n_features = Xty.shape
+    coefficients = np.full((n_pixels, n_features), np.nan)
+    solvable = np.linalg.matrix_rank(XtX) == n_features
+    if solvable.any():
+        coefficients[solvable] = np.linalg.solve(XtX[solvable], Xty[solvable][..., None])[..., 0]
+    return coefficients
+
+def harmonic(scenes, start_date, shape):
+    # Fits the harmonic model to a stream of (date, EVI) scenes, each EVI
+    # shaped (y, x). Returns a band for each coefficient, named as in
+    # 1_2_trends_harmonic.py.
+    XtX = Xty = None
+    for date, EVI in scenes:
+        features = harmonic_features([date], start_date)
+        XtX, Xty = accumulate_normal_equations(EVI[None], features, XtX, Xty)
+    coefficients = solve_normal_equations(XtX, Xty).astype(np.float32)
+    return {f'{name}_EVI': coefficients[:, i].reshape(shape)
+            for i, name in enumerate(harmonic_bands)}
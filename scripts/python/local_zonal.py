@@ -0,0 +1,153 @@
+##########################################################
+# Zonal statistics over the 10 km EPSG:5070 grid used by
+# the gridded_*.js scripts. The grid is rasterized once
+# into an int32 zone raster (the index of the grid cell
+# containing each pixel centre, -1 outside the grid), and
+# per-zone statistics are accumulated with np.bincount.
+##########################################################
+
+import json
+import math
+import os
+
+import numpy as np
+import rasterio as rio
+from rasterio import features
+from rasterio.warp import transform_geom
+from rasterio.windows import Window, from_bounds
+
+import local_denoise
+
+# Authalic radius of the WGS84 ellipsoid, for pixel areas in degrees.
+EARTH_RADIUS = 6371007.2
+
+
+def read_grid(path):
+    # Ids and geometries (EPSG:4326) of a grid exported as GeoJSON.
+    with open(path, 'r') as f:
+        collection = json.load(f)
+    ids = [feature['properties'].get('id', feature.get('id')) for feature in collection['features']]
+    geometries = [feature['geometry'] for feature in collection['features']]
+    return ids, geometries
+
+def grid_window(src, geometries, grid_crs='EPSG:4326'):
+    # Window of an open raster covering every grid cell.
+    bounds = np.array([features.bounds(transform_geom(grid_crs, src.crs, geometry))
+                       for geometry in geometries])
+    window = from_bounds(bounds[:, 0].min(), bounds[:, 1].min(), bounds[:, 2].max(),
+                         bounds[:, 3].max(), transform=src.transform)
+    col_off, row_off = math.floor(window.col_off), math.floor(window.row_off)
+    window = Window(col_off, row_off,
+                    math.ceil(window.col_off + window.width) - col_off,
+                    math.ceil(window.row_off + window.height) - row_off)
+    return window.intersection(Window(0, 0, src.width, src.height))
+
+def rasterize_zones(geometries, shape, transform, crs, grid_crs='EPSG:4326'):
+    # Zone raster on a pixel grid: the index of the geometry containing
+    # each pixel centre, -1 where there is none.
+    shapes = ((transform_geom(grid_crs, crs, geometry), i) for i, geometry in enumerate(geometries))
+    return features.rasterize(shapes, out_shape=shape, transform=transform, fill=-1, dtype='int32')
+
+def zonal_sums(values, zones, n_zones, sums=None, counts=None):
+    # Adds the sum and number of valid (non-NaN) values in every zone of a
+    # 2-D array to running (n_zones,) totals.
+    if sums is None:
+        sums = np.zeros(n_zones)
+        counts = np.zeros(n_zones, dtype=np.int64)
+    valid = (zones >= 0) & ~np.isnan(values)
+    zone = zones[valid]
+    sums += np.bincount(zone, weights=values[valid], minlength=n_zones)
+    counts += np.bincount(zone, minlength=n_zones)
+    return sums, counts
+
+def zonal_means(values, zones, n_zones):
+    # Mean of every zone for each image of a (t, y, x) stack, as (t, n_zones),
+    # NaN for zones without valid pixels. Every image is reduced with a
+    # single bincount over time and zone.
+    n_time = values.shape[0]
+    valid = (zones >= 0) & ~np.isnan(values)
+    time_index = np.broadcast_to(np.arange(n_time)[:, None, None], values.shape)
+    index = time_index[valid] * n_zones + np.broadcast_to(zones, values.shape)[valid]
+    sums = np.bincount(index, weights=values[valid], minlength=n_time * n_zones)
+    counts = np.bincount(index, minlength=n_time * n_zones)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (sums / counts).reshape(n_time, n_zones)
+
+def pixel_areas(transform, crs, rows):
+    # Area (m^2) of the pixels in each of the given rows, as
+    # ee.Image.pixelArea. Constant for projected rasters.
+    if not crs.is_geographic:
+        return np.full(len(rows), abs(transform.a * transform.e))
+    top = np.radians(transform.f + transform.e * np.asarray(rows))
+    bottom = np.radians(transform.f + transform.e * (np.asarray(rows) + 1))
+    return EARTH_RADIUS**2 * np.radians(abs(transform.a)) * np.abs(np.sin(top) - np.sin(bottom))
+
+
+##################################################################
+# Zone rasters aligned with large rasters
+##################################################################
+
+def build_zone_raster(src, geometries, path, tile_size=4096):
+    # Rasterizes the grid once onto the pixel grid of an open raster and
+    # saves it as a tiled int32 GeoTIFF, so every raster on the same grid
+    # (e.g. each year of defoliation) can reuse it.
+    profile = dict(driver='GTiff', width=src.width, height=src.height, count=1, dtype='int32',
+                   crs=src.crs, transform=src.transform, nodata=-1, tiled=True,
+                   blockxsize=512, blockysize=512, compress='deflate')
+    with rio.open(path + '.tmp', 'w', **profile) as dst:
+        for rows, cols in local_denoise.tiles((src.height, src.width), tile_size):
+            window = Window.from_slices(rows, cols)
+            zones = rasterize_zones(geometries, (int(window.height), int(window.width)),
+                                    src.window_transform(window), src.crs)
+            dst.write(zones, 1, window=window)
+    os.replace(path + '.tmp', path)
+
+def raster_zonal_sums(path, geometries, layers, indexes=None, zones_path=None, tile_size=4096):
+    # Area weighted sums per zone of layers derived from a raster, read tile
+    # by tile. layers(block) maps a (band, y, x) float block, with masked
+    # pixels as NaN, to a dict of named 2-D arrays (NaN where the layer is
+    # masked). Returns dicts of (n_zones,) sums, as ee.Image.pixelArea() *
+    # layer summed by reduceRegions, and of valid pixel counts.
+    n_zones = len(geometries)
+    sums, counts = {}, {}
+    with rio.open(path) as src:
+        zones_src = None
+        if zones_path is not None:
+            if not os.path.exists(zones_path):
+                build_zone_raster(src, geometries, zones_path, tile_size)
+            zones_src = rio.open(zones_path)
+            assert zones_src.shape == src.shape and zones_src.transform == src.transform, \
+                f"{zones_path} is not aligned with {path}."
+
+        for rows, cols in local_denoise.tiles((src.height, src.width), tile_size):
+            window = Window.from_slices(rows, cols)
+            if zones_src is not None:
+                zones = zones_src.read(1, window=window)
+            else:
+                zones = rasterize_zones(geometries, (int(window.height), int(window.width)),
+                                        src.window_transform(window), src.crs)
+            if not (zones >= 0).any():
+                continue
+
+            block = src.read(indexes, window=window, masked=True).astype(np.float64).filled(np.nan)
+            areas = pixel_areas(src.transform, src.crs, np.arange(rows.start, rows.stop))[:, None]
+            for name, layer in layers(block).items():
+                sums[name], counts[name] = zonal_sums(layer * areas, zones, n_zones,
+                                                      sums.get(name), counts.get(name))
+        if zones_src is not None:
+            zones_src.close()
+    return sums, counts
+
+def write_grid(path, ids, geometries, columns):
+    # Writes grid cells with per-zone columns as GeoJSON, in the layout
+    # exported by the gridded_*.js scripts. NaN values are written as null.
+    collection = {'type':'FeatureCollection', 'features':[]}
+    for i, (zone_id, geometry) in enumerate(zip(ids, geometries)):
+        properties = {'id':zone_id}
+        for name, values in columns.items():
+            value = np.asarray(values[i]).item()
+            properties[name] = None if value != value else value
+        collection['features'].append({'type':'Feature', 'id':zone_id, 'geometry':geometry,
+                                       'properties':properties})
+    with open(path, 'w') as f:
+        json.dump(collection, f)
@@ -0,0 +1,156 @@
+##########################################################
+# Dry-run planning for the pipeline scripts. When a script
+# is run without --submit, the coveringGrid cells it would
+# export are reported with, for every tile and year, the
+# pixel count at preprocessing.resolutions, the expected
+# number of scenes per pixel, the bytes read and written,
+# and the runtime predicted from benchmark.py results, and
+# the script exits before anything is exported. Tiles whose
+# in-memory stack would exceed a memory budget are flagged,
+# to help choose --width/--length. Its options are defined
+# by scheduler.add_arguments.
+##########################################################
+
+import calendar
+import json
+import sys
+
+import numpy as np
+
+import local_preprocessing
+
+# Days between observations of a pixel (Sentinel-2A/B, Landsat 8/9,
+# daily MODIS, and the combined HLS constellation).
+revisit_days = {'Sentinel2':5, 'Landsat':8, 'MODIS':1, 'HLS':3}
+
+# Bytes per pixel of each raw band read, and of the float32 EVI cube.
+BAND_BYTES = 2
+EVI_BYTES = 4
+
+# Revisit of the synthetic cubes benchmark.py measures throughput on.
+BENCHMARK_REVISIT = 5
+
+# Stages of benchmark.py whose cost grows with the number of scenes,
+# rather than with the number of yearly maps.
+scene_stages = ['preprocessing', 'phenology', 'theil_sen', 'anomaly']
+
+
+def cell_bounds(grid):
+    # (west, south, east, north) of every cell of a coveringGrid, from
+    # grid.getInfo().
+    from shapely.geometry import shape
+    return [shape(feature['geometry']).bounds for feature in grid['features']]
+
+def tile_pixels(bounds, crs, resolution):
+    # Pixels in the export of a cell: its bounding box in the output CRS at
+    # the output resolution. Edges are densified before reprojecting.
+    # shapely and rasterio are imported here, so that submitting a run does
+    # not need them.
+    import shapely
+    from rasterio.warp import transform_geom
+    from shapely.geometry import box, shape
+
+    cell = shapely.segmentize(box(*bounds), 0.01)
+    west, south, east, north = shape(transform_geom('EPSG:4326', crs, cell.__geo_interface__)).bounds
+    return int(np.ceil((east - west) / resolution) * np.ceil((north - south) / resolution))
+
+def expected_scenes(source, year):
+    # Expected observations of each pixel in a year.
+    days = 366 if calendar.isleap(year) else 365
+    return int(np.ceil(days / revisit_days[source]))
+
+def load_throughput(path):
+    # Pixels per second of each stage from a benchmark.py --output report,
+    # converted to pixel-scenes per second for the scene stages and to
+    # pixel-years per second for the others.
+    with open(path, 'r') as f:
+        report = json.load(f)
+    n_years = report['end'] - report['start'] + 1
+    throughput = {}
+    for stage, summary in report['stages'].items():
+        rate = summary['pixels_per_second'] * n_years
+        if stage in scene_stages:
+            rate *= 365.25 / BENCHMARK_REVISIT
+        throughput[stage] = rate
+    return throughput
+
+def plan(cells, source, crs, resolution, years, stages, read_scenes=True,
+         read_bytes_per_year=0, written_per_year=0, written_per_run=0,
+         series=True, throughput=None):
+    # Rows for every tile and year. read_scenes is False for scripts that
+    # read yearly maps (read_bytes_per_year per pixel) instead of scenes.
+    # written_per_year/written_per_run are output bytes per pixel, and
+    # series is True when all years are held in memory together (model
+    # fits) rather than one year at a time.
+    n_bands = len(local_preprocessing.bands[source])
+    rows = []
+    for tile, bounds in enumerate(cells):
+        pixels = tile_pixels(bounds, crs, resolution)
+        for k, year in enumerate(years):
+            scenes = expected_scenes(source, year) if read_scenes else 0
+            bytes_read = pixels * (scenes * n_bands * BAND_BYTES + read_bytes_per_year)
+            memory = pixels * (scenes * (n_bands * BAND_BYTES + EVI_BYTES)
+                               + read_bytes_per_year)
+            seconds = None
+            if throughput is not None:
+                seconds = 0.0
+                for stage in stages:
+                    if stage in throughput:
+                        work = pixels * scenes if stage in scene_stages else pixels
+                        seconds += work / throughput[stage]
+            written = pixels * written_per_year
+            if k == len(years) - 1:
+                written += pixels * written_per_run
+            rows.append({'tile':tile, 'year':year, 'pixels':pixels, 'scenes':scenes,
+                         'bytes_read':bytes_read, 'bytes_written':written,
+                         'seconds':seconds, 'memory':memory})
+
+    # Memory of a tile is the stack of every year for model fits, or of
+    # its largest year otherwise.
+    for tile in range(len(cells)):
+        tile_rows = [row for row in rows if row['tile'] == tile]
+        peak = sum(row['memory'] for row in tile_rows) if series else max(row['memory'] for row in tile_rows)
+        for row in tile_rows:
+            row['tile_memory'] = peak
+    return rows
+
+def report(rows, memory_budget=None):
+    # Prints the plan, with totals and the tiles over the memory budget (GB).
+    def gigabytes(n):
+        return f'{n / 1e9:,.2f} GB'
+    def duration(seconds):
+        return 'unknown' if seconds is None else f'{seconds / 3600:,.2f} h'
+
+    print(f"{'tile':>5} {'year':>5} {'pixels':>14} {'scenes':>7} {'read':>14} "
+          f"{'written':>12} {'runtime':>10}")
+    for row in rows:
+        print(f"{row['tile']:>5} {row['year']:>5} {row['pixels']:>14,} {row['scenes']:>7} "
+              f"{gigabytes(row['bytes_read']):>14} {gigabytes(row['bytes_written']):>12} "
+              f"{duration(row['seconds']):>10}")
+
+    pixels = {row['tile']:row['pixels'] for row in rows}
+    seconds = [row['seconds'] for row in rows]
+    total_seconds = None if None in seconds else sum(seconds)
+    print(f"{len(pixels)} tiles, {sum(pixels.values()):,} pixels, "
+          f"{gigabytes(sum(row['bytes_read'] for row in rows))} read, "
+          f"{gigabytes(sum(row['bytes_written'] for row in rows))} written, "
+          f"{duration(total_seconds)} single-core runtime")
+
+    peaks = {row['tile']:row['tile_memory'] for row in rows}
+    print(f'Largest tile in memory: {gigabytes(max(peaks.values()))}')
+    if memory_budget is not None:
+        over = [tile for tile, peak in peaks.items() if peak > memory_budget * 1e9]
+        for tile in over:
+            print(f'WARNING: tile {tile} needs {gigabytes(peaks[tile])}, over the '
+                  f'{memory_budget:g} GB budget; use a smaller --width/--length.')
+    return rows
+
+def run(args, grid, source, resolution, years, stages, **costs):
+    # Prints the plan of every cell of the grid (an ee.FeatureCollection)
+    # and exits, so nothing is exported. Called by the scripts when
+    # --submit is not given. costs are passed on to plan.
+    throughput = None if args.throughput is None else load_throughput(args.throughput)
+    rows = plan(cell_bounds(grid.getInfo()), source, args.crs, resolution, years, stages,
+                throughput=throughput, **costs)
+    report(rows, args.memory_budget)
+    sys.exit(0)
@@ -0,0 +1,100 @@
+##########################################################
+# Encoding and decoding of the bit-packed QA masks written
+# by data_wrangling/observations.py:
+#
+#   forest << 15 | strong_obs << 10 | preseason << 5 | weak_obs
+#
+# where strong_obs, preseason and weak_obs are 5 bit fields
+# with bit (year - 2019) set for each year from 2019 to 2023.
+# NumPy is imported inside the array functions, so that
+# masking.py can use the mask values when submitting a run
+# without it.
+##########################################################
+
+from functools import lru_cache
+
+FIRST_YEAR = 2019
+LAST_YEAR = 2023
+years = list(range(FIRST_YEAR, LAST_YEAR + 1))
+
+# Position of the lowest bit of each flag.
+shifts = {'weak_obs':0, 'preseason':5, 'strong_obs':10, 'forest':15}
+yearly_flags = ['weak_obs', 'preseason', 'strong_obs']
+
+
+##################################################################
+# Mask values
+##################################################################
+
+def flag_bit(flag, year=None):
+    if flag == 'forest':
+        return 1 << shifts['forest']
+    assert FIRST_YEAR <= year <= LAST_YEAR, f"No QA bits for {year}."
+    return 1 << (shifts[flag] + year - FIRST_YEAR)
+
+def mask_value(year, flags):
+    # Combined value of the given flags for a year, e.g.
+    # mask_value(2020, ['forest', 'preseason', 'weak_obs']).
+    return sum(flag_bit(flag, year) for flag in flags)
+
+def mask_value_v1(year):
+    # Mask used by masking.generate_qa_mask_v1: forest, strong observations
+    # in the target year and no preseason anomaly in any year up to it.
+    value = flag_bit('forest') + flag_bit('strong_obs', year)
+    for prior_year in range(FIRST_YEAR, year + 1):
+        value += flag_bit('preseason', prior_year)
+    return value
+
+
+##################################################################
+# Encoding
+##################################################################
+
+def encode(forest, strong_obs, preseason, weak_obs):
+    # Packs a forest mask (y, x) and yearly masks (year, y, x) into uint16.
+    import numpy as np
+
+    qa = np.asarray(forest, dtype=np.uint16) << shifts['forest']
+    for flag, masks in zip(['strong_obs', 'preseason', 'weak_obs'],
+                           [strong_obs, preseason, weak_obs]):
+        for i, mask in enumerate(masks):
+            qa |= np.asarray(mask, dtype=np.uint16) << (shifts[flag] + i)
+    return qa
+
+
+##################################################################
+# Decoding with lookup tables
+##################################################################
+
+@lru_cache(maxsize=None)
+def validity_table(value):
+    # True for every uint16 QA value with all bits of `value` set.
+    import numpy as np
+
+    table = (np.arange(1 << 16, dtype=np.uint32) & value) == value
+    table.flags.writeable = False
+    return table
+
+@lru_cache(maxsize=None)
+def field_table(flag):
+    # Maps every uint16 QA value to the 5 bit yearly field of a flag.
+    import numpy as np
+
+    table = ((np.arange(1 << 16, dtype=np.uint32) >> shifts[flag]) & 0b11111).astype(np.uint8)
+    table.flags.writeable = False
+    return table
+
+def is_valid(qa, value):
+    # One table lookup per pixel instead of bitwise expressions.
+    return validity_table(value)[qa]
+
+def decode(qa, flag, year=None):
+    # Boolean mask of a single flag, for a single year if the flag is yearly.
+    return is_valid(qa, flag_bit(flag, year))
+
+def decode_field(qa, flag):
+    # Boolean (year, y, x) masks of a yearly flag for every year.
+    import numpy as np
+
+    field = field_table(flag)[qa]
+    return np.stack([(field >> i) & 1 for i in range(len(years))]).astype(bool)
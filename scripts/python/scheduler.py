@@ -0,0 +1,167 @@
+##########################################################
+# Runs per-tile jobs for the coveringGrid loop in parallel,
+# keeping an on-disk ledger of finished tiles so that an
+# interrupted run resumes where it stopped.
+#
+# Jobs are run either directly on a process pool (local
+# backend) or through objects with the start()/status()
+# interface of ee.batch.Task (task queue). LocalTask is a
+# stand-in for ee.batch.Task that runs on the local pool.
+##########################################################
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import json
+import os
+import time
+
+
+def add_arguments(parser):
+    # Options for planning and submitting the tiles of a run. They are
+    # defined here rather than in planner.py, so that submitting a run does
+    # not import it.
+
+    # benchmark.py results (--output) to predict runtimes from when planning.
+    parser.add_argument('--throughput', action='store', default=None)
+
+    # Memory budget (GB) to flag tiles against when planning.
+    parser.add_argument('--memory_budget', action='store', type=float, default=16)
+
+    # Most tiles to have running at once.
+    parser.add_argument('--max_in_flight', action='store', type=int, default=10)
+
+    # JSON-lines ledger of finished tiles, so an interrupted run resumes
+    # where it stopped. Defaults to one named after the run.
+    parser.add_argument('--ledger', action='store', default=None)
+
+
+##################################################################
+# Ledger of completed tiles
+##################################################################
+
+def ledger_key(tile):
+    # Tiles are stored as JSON, which turns tuples into lists, so tiles are
+    # compared by their JSON encoding on both sides of the ledger.
+    return json.dumps(tile)
+
+def load_ledger(path):
+    # Tiles already completed in a previous run, keyed by ledger_key.
+    if not os.path.exists(path):
+        return {}
+    completed = {}
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                entry = json.loads(line)
+                completed[ledger_key(entry['tile'])] = entry.get('result')
+    return completed
+
+def record_tile(path, tile, result=None):
+    # Append a completed tile, flushing so the entry survives interruption.
+    with open(path, 'a') as f:
+        f.write(json.dumps({'tile':tile, 'result':result}) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+##################################################################
+# Local backend
+##################################################################
+
+def run_tiles(job, tiles, ledger, workers=os.cpu_count(), max_in_flight=None, args=()):
+    # Runs job(tile, *args) for every tile not yet in the ledger, with at
+    # most max_in_flight tiles submitted at once. job must be picklable
+    # (a module-level function). Returns the errors of the tiles that
+    # failed, keyed by ledger_key.
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+    completed = load_ledger(ledger)
+    pending = [tile for tile in tiles if ledger_key(tile) not in completed]
+    failed = {}
+
+    def collect(done):
+        for future in done:
+            tile = in_flight.pop(future)
+            try:
+                result = future.result()
+            except Exception as error:
+                failed[ledger_key(tile)] = repr(error)
+                print(f'Tile {tile} failed: {error!r}')
+            else:
+                record_tile(ledger, tile, result)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = {}
+        for tile in pending:
+            if len(in_flight) >= max_in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            in_flight[executor.submit(job, tile, *args)] = tile
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            collect(done)
+    return failed
+
+
+##################################################################
+# Task queue
+##################################################################
+
+def run_tasks(make_task, tiles, ledger, max_in_flight=10, poll_interval=5):
+    # Starts make_task(tile) for every tile not yet in the ledger, keeping
+    # at most max_in_flight tasks running. Tasks follow the ee.batch.Task
+    # interface. Returns the errors of the tiles that failed, keyed by
+    # ledger_key.
+    completed = load_ledger(ledger)
+    pending = [tile for tile in tiles if ledger_key(tile) not in completed]
+    failed = {}
+    running = {}
+
+    def poll():
+        for key, (tile, task) in list(running.items()):
+            status = task.status()
+            if status['state'] == 'COMPLETED':
+                record_tile(ledger, tile, status.get('id'))
+                del running[key]
+            elif status['state'] in ['FAILED', 'CANCELLED']:
+                failed[key] = status.get('error_message', status['state'])
+                print(f'Tile {tile} failed: {failed[key]}')
+                del running[key]
+
+    for tile in pending:
+        while len(running) >= max_in_flight:
+            time.sleep(poll_interval)
+            poll()
+        task = make_task(tile)
+        task.start()
+        running[ledger_key(tile)] = (tile, task)
+    while running:
+        time.sleep(poll_interval)
+        poll()
+    return failed
+
+class LocalTask:
+    # Stand-in for ee.batch.Task that runs function(*args) on a local
+    # process pool when started.
+    def __init__(self, executor, function, *args, description=None):
+        self.executor = executor
+        self.function = function
+        self.args = args
+        self.description = description
+        self.future = None
+
+    def start(self):
+        self.future = self.executor.submit(self.function, *self.args)
+
+    def status(self):
+        status = {'id':self.description, 'description':self.description}
+        if self.future is None:
+            status['state'] = 'READY'
+        elif not self.future.done():
+            status['state'] = 'RUNNING'
+        elif self.future.exception() is not None:
+            status['state'] = 'FAILED'
+            status['error_message'] = repr(self.future.exception())
+        else:
+            status['state'] = 'COMPLETED'
+        return status
@@ -0,0 +1,98 @@
+##########################################################
+# Reproducible synthetic Sentinel-2 cubes built from the
+# modified double logistic model in
+# notebooks/F2_FullMethodsGraphs.ipynb, with normal,
+# slightly defoliated, severely defoliated and harvested
+# pixels and patchy cloud cover.
+##########################################################
+
+import numpy as np
+
+import local_preprocessing
+
+pixel_types = ['normal', 'slight_defol', 'severe_defol', 'harvest']
+
+# Parameters for modified double logistic model
+a = 0.2 # Minimum EVI
+b = 0.8 # Range of EVI
+c = 0.0007 # Slope of greendown trend
+m_1 = -0.4 # Slope of first logistic
+m_2 = -0.07 # Slope of second logistic
+n_1 = 150 # Start of Season
+n_2 = 290 # End of Season
+
+# Parameters of slight defoliation
+b_d = 0.1 # Decrease in maximum EVI
+
+# Parameters of severe defoliation
+d = 0.4 # Strength of defol
+m_3 = 0.004 # Rate of defoliation
+n_3 = 180 # ~ Date of Peak Defoliation
+
+# Modified parameters of off-season harvesting
+n_h = 180
+b_h = 0.3
+
+
+def double_logistic(x, a=a, b=b, c=c, m_1=m_1, m_2=m_2, n_1=n_1, n_2=n_2):
+    return a + (b - c*x) * ( 1/(1+np.exp(m_1*(x - n_1))) - 1/(1+np.exp(m_2*(x - n_2))) )
+
+def blobs(rng, shape, scale):
+    # Spatially smooth random field in [0, 1), made by upsampling coarse noise.
+    coarse = rng.random((shape[0] // scale + 2, shape[1] // scale + 2))
+    field = coarse.repeat(scale, axis=0).repeat(scale, axis=1)
+    offset = rng.integers(0, scale, 2)
+    return field[offset[0]:offset[0] + shape[0], offset[1]:offset[1] + shape[1]]
+
+def pixel_type_map(rng, shape, fractions, scale=20):
+    # Assign each pixel a type in patches, with the given fraction of each type.
+    field = blobs(rng, shape, scale) + rng.random(shape) * 0.05
+    edges = np.quantile(field, np.cumsum(fractions)[:-1])
+    return np.searchsorted(edges, field).astype(np.uint8)
+
+def synthetic_cube(shape, start=2019, end=2023, revisit=5, cloud_cover=0.55,
+                   fractions=(0.7, 0.1, 0.15, 0.05), noise=0.02, seed=0):
+    # Returns a Sentinel-2 like (time, band, y, x) stack with bands ordered
+    # as in local_preprocessing.bands['Sentinel2'], the scene dates, the
+    # noise free EVI (time, y, x), the pixel type of each pixel and the
+    # year in which each disturbed pixel is disturbed.
+    rng = np.random.default_rng(seed)
+    dates = np.arange(np.datetime64(f'{start}-01-01'), np.datetime64(f'{end + 1}-01-01'),
+                      np.timedelta64(revisit, 'D'))
+    years = dates.astype('datetime64[Y]').astype(np.int64) + 1970
+    x = local_preprocessing.day_of_year(dates).astype(np.float32)[:, None, None]
+
+    types = pixel_type_map(rng, shape, fractions)
+    disturbed_year = rng.integers(start, end + 1, shape)
+    disturbed = (years[:, None, None] == disturbed_year) & (types > 0)
+
+    # Per pixel variation in phenology
+    start_of_season = n_1 + rng.normal(0, 5, shape).astype(np.float32)
+    range_EVI = b + rng.normal(0, 0.05, shape).astype(np.float32)
+
+    EVI = double_logistic(x, b=range_EVI, n_1=start_of_season).astype(np.float32)
+    slight = disturbed & (types == 1)
+    severe = disturbed & (types == 2)
+    harvest = disturbed & (types == 3)
+    seasonal = ( 1/(1+np.exp(m_1*(x - start_of_season))) - 1/(1+np.exp(m_2*(x - n_2))) )
+    EVI -= np.where(slight | severe, b_d * seasonal, 0).astype(np.float32)
+    EVI -= np.where(severe, d*np.exp(-m_3*(x - n_3)**2), 0).astype(np.float32)
+    harvested = double_logistic(x, b=range_EVI - b_h, n_1=n_h).astype(np.float32)
+    EVI = np.where(harvest, harvested, EVI)
+
+    # Reflectances consistent with the EVI of each scene
+    observed = EVI + rng.normal(0, noise, EVI.shape).astype(np.float32)
+    blue = rng.uniform(0.02, 0.05, EVI.shape).astype(np.float32)
+    red = (0.12 - 0.1 * observed).astype(np.float32)
+    # Invert EVI = 2.5 * (NIR - RED) / (NIR + 6 * RED - 7.5 * BLUE + 1)
+    nir = (observed * (6 * red - 7.5 * blue + 1) + 2.5 * red) / (2.5 - observed)
+
+    # Patchy clouds, with cloud cover varying between scenes
+    cover = rng.beta(2 * cloud_cover, 2 * (1 - cloud_cover), len(dates))
+    cs_cdf = np.empty(EVI.shape, dtype=np.float32)
+    for t in range(len(dates)):
+        cloudy = blobs(rng, shape, 25) < cover[t]
+        cs_cdf[t] = np.where(cloudy, rng.uniform(0, 0.5, shape), rng.uniform(0.7, 1, shape))
+
+    stack = np.stack([blue * 10_000, red * 10_000, nir * 10_000, cs_cdf], axis=1)
+    return stack.astype(np.float32), dates, EVI, types, disturbed_year
@@ -4,6 +4,8 @@
 
 import ee       # Google Earth Engine API
 
+import qa_codec
+
 try:
     ee.Initialize(project='ee-cjc378')
 except:
@@ -18,8 +20,9 @@ for year in [2019, 2020, 2021, 2022]:
     ##################################################################
     
     qa_masks = ee.ImageCollection('projects/ee-cjc378/assets/qa_masks_New_York').mosaic()
-    mask_curr = ee.Number(2).pow(ee.Number(year).subtract(2019)).multiply(33).add(32768).toUint16()
-    mask_next = ee.Number(2).pow(ee.Number(year+1).subtract(2019)).multiply(33).add(32768).toUint16()
+    mask_flags = ['forest', 'preseason', 'weak_obs']
+    mask_curr = ee.Number(qa_codec.mask_value(year, mask_flags)).toUint16()
+    mask_next = ee.Number(qa_codec.mask_value(year+1, mask_flags)).toUint16()
     qa_masks_marked_curr = qa_masks.bitwiseAnd(mask_curr).eq(mask_curr)
     qa_masks_marked_next = qa_masks.bitwiseAnd(mask_next).eq(mask_next)
 